@@ -1,12 +1,61 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import uvicorn
+import asyncio
 import json
 import os
+import logging
+from contextlib import asynccontextmanager
 
 from src.pipeline import update_blog_article_pipeline
+from src.utils import (
+    refresh_jwt_token, jwt_refresh_backoff, jwt_credentials_rejected, JWT_REFRESH_MAX_REJECTIONS
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def keep_jwt_token_fresh(username, password):
+    """
+    Renew the WordPress token ahead of its expiry so pipelines never authenticate on the request path.
+    Backs off exponentially after failures and stops once WordPress keeps rejecting the credentials.
+    """
+    failures = rejections = 0
+    while True:
+        try:
+            delay = await asyncio.to_thread(refresh_jwt_token, username, password)
+            failures = rejections = 0
+        except Exception as e:
+            failures += 1
+            rejections = rejections + 1 if jwt_credentials_rejected(e) else 0
+            if rejections >= JWT_REFRESH_MAX_REJECTIONS:
+                logger.critical(
+                    f"[API] WordPress rejected the credentials {rejections} times in a row, "
+                    f"background JWT refresh stopped: check USERNAME_WP/PASSWORD_WP"
+                )
+                return
+            delay = jwt_refresh_backoff(failures)
+            logger.error(f"[API] JWT refresh failed ({e}), next attempt in {delay}s")
+        await asyncio.sleep(delay)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    username, password = os.getenv("USERNAME_WP"), os.getenv("PASSWORD_WP")
+    refresher = asyncio.create_task(keep_jwt_token_fresh(username, password)) if username and password else None
+    yield
+    if refresher:
+        refresher.cancel()
 
-app = FastAPI(title="Article Rewriter API", version="1.0.0")
+
+# Responses carry the full updated article HTML: serialize them with orjson rather than the stdlib encoder
+app = FastAPI(
+    title="Article Rewriter API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -24,8 +73,8 @@ async def update_blog_article_endpoint(request: dict):
     Update a blog article using the pipeline from AI-Copywriter
     """
     try:
-        print(f"[API] Processing request for URL: {request.get('article_url')}")
-        print(f"[API] Subject: {request.get('subject')}")
+        logger.info(f"[API] Processing request for URL: {request.get('article_url')}")
+        logger.info(f"[API] Subject: {request.get('subject')}")
 
         # Validate required fields
         if not request.get('article_url') or not request.get('subject'):
@@ -36,11 +85,12 @@ async def update_blog_article_endpoint(request: dict):
             "article_url": request["article_url"],
             "subject": request["subject"],
             "link": "dummy_link",  # Not used since we're not using SupaData
-            "additional_content": request.get("additional_content", "")
+            "additional_content": request.get("additional_content", ""),
+            "mode": request.get("mode", "online")  # "bulk" routes block updates through the Batches API
         }
 
-        # Call the pipeline
-        result = update_blog_article_pipeline(data)
+        # Call the pipeline off the event loop (it drives its own loop for the block updates)
+        result = await asyncio.to_thread(update_blog_article_pipeline, data)
 
         if result.get("error"):
             raise HTTPException(status_code=500, detail=result["error"])
@@ -53,10 +103,7 @@ async def update_blog_article_endpoint(request: dict):
         }
 
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"[ERROR] API request failed: {str(e)}")
-        print(f"[ERROR] Full traceback: {error_details}")
+        logger.exception(f"[API] Request failed: {e}")
         raise HTTPException(status_code=500, detail=f"Erreur interne: {str(e)}")
 
 @app.get("/health")
@@ -1,18 +1,50 @@
 import os
+import re
+import time
+import asyncio
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import anthropic
+import orjson
 from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 from langchain_anthropic import ChatAnthropic
 
+from .utils import HTML_PARSER, count_structure_tags, html_text
+from .rate_limiter import wait_for_capacity, wait_for_capacity_async
+
 logger = logging.getLogger(__name__)
 
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+# Output budgets per kind of call (one ChatAnthropic is shared per temperature/budget pair for the sync calls)
+BLOCK_MAX_TOKENS = 4096
+DIAGNOSE_MAX_TOKENS = 4096
+GENERATE_MAX_TOKENS = int(os.getenv("GENERATE_MAX_TOKENS", "8000"))
+SUMMARY_MAX_TOKENS = 2000
+BATCH_POLL_INTERVAL = int(os.getenv("BATCH_POLL_INTERVAL", "10"))
+BATCH_TIMEOUT = int(os.getenv("BATCH_TIMEOUT", "3600"))
 
-def update_block_if_needed(block, subject, additional_content):
-    """Update a single block if needed"""
-    title = block['title']
-    content_html = "\n".join([str(e) for e in block['content']])
-    title_text = title.get_text() if title else "Sans titre"
+# Headings/media the structured merge may drop before falling back to plain concatenation
+MERGE_MAX_LOST_TAGS = int(os.getenv("MERGE_MAX_LOST_TAGS", "0"))
 
-    prompt = f"""
+# Contract: a status line (possibly after a short preamble), then the HTML if any
+_STATUS_RE = re.compile(r"STATUS:\s*(VALID|TO BE UPDATED|OUTDATED)\s*\n?(.*)", re.DOTALL)
+
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+
+# Output budget for a grouped evaluation, which may rewrite several sections at once
+SECTIONS_MAX_TOKENS = int(os.getenv("SECTIONS_MAX_TOKENS", "16000"))
+
+# Claude's answers to identical block prompts, reused when an article is processed again (0 disables)
+BLOCK_CACHE_SIZE = int(os.getenv("BLOCK_CACHE_SIZE", "512"))
+_block_answers = OrderedDict()
+_block_answers_lock = threading.Lock()
+
+
+BLOCK_PROMPT_TEMPLATE = """
 ### ROLE
 You're a French world-class copywriter specializing in video games. Your job is to update and improve article sections based on additional content provided.
 
@@ -40,49 +72,410 @@ You're a French world-class copywriter specializing in video games. Your job is
 - Never exceed three lines per paragraph. Cut long ideas into several shorter blocks.
 
 Sujet : {subject}
-Titre : {title_text}
+
+Contenu additionnel :
+{additional_content}
+"""
+
+# Block-specific part, kept after the article-wide prefix so that prefix can be cached
+BLOCK_SECTION_TEMPLATE = """Titre : {title_text}
 
 Contenu HTML :
 {content_html}
 
+Évalue cette section et mets-la à jour si besoin.
+"""
+
+
+def _cacheable_prompt(prefix, suffix):
+    """
+    Prompt as content blocks, the prefix shared by all calls of an article marked for Anthropic prompt caching
+    """
+    return [
+        {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": suffix}
+    ]
+
+
+def block_title_text(block):
+    """Plain-text title of a block, "Sans titre" when it has none"""
+    title = block['title']
+    if not title:
+        return "Sans titre"
+    # Headings are single tags with inline markup at most: no parser needed to drop the tags
+    return html_text(str(title), separator="").strip() or "Sans titre"
+
+
+def block_content_html(block):
+    """Serialize a block's content elements once, for prompts and size logs"""
+    return "\n".join(map(str, block['content']))
+
+
+def build_block_prompt(subject, title_text, content_html, additional_content):
+    """Build the evaluation prompt (content blocks) for a single block"""
+    return _cacheable_prompt(
+        BLOCK_PROMPT_TEMPLATE.format(subject=subject, additional_content=additional_content),
+        BLOCK_SECTION_TEMPLATE.format(title_text=title_text, content_html=content_html)
+    )
+
+
+SECTIONS_PROMPT_TEMPLATE = """
+### ROLE
+You're a French world-class copywriter specializing in video games. Your job is to update and improve article sections based on additional content provided.
+
+### GOAL
+- For each numbered section, identify if it is:
+  - VALID (still accurate and aligned with the additional content)
+  - TO BE UPDATED (partially outdated or missing context)
+  - OUTDATED (no longer valid and must be rewritten)
+
+### VERIFICATION STRATEGY
+- Compare each section line by line to the additional content.
+- If a section mentions features/events/patches that the additional content contradicts or no longer includes, flag it.
+- If a minor fix is needed, rewrite only the outdated parts.
+
+### INSTRUCTIONS
+- Answer only with a compact JSON array wrapped in ```json fences, one object per section:
+  [{{"id": 1, "status": "VALID", "html": ""}}, {{"id": 2, "status": "TO BE UPDATED", "html": "<p>...</p>"}}]
+- "status" is one of "VALID", "TO BE UPDATED", "OUTDATED".
+- If VALID → "html" is an empty string.
+- If TO BE UPDATED → "html" is the corrected version of the section content.
+- If OUTDATED → "html" is the rewritten version of the section content.
+- Never include the section title in "html".
+- Use <p>, <ul>, <li>, <strong>, <em>, etc. No <div>, no inline styles.
+- No brands, names or YouTube references.
+- Write in French.
+
+### TECHNICAL LIMITATIONS
+- Never use long dashes (—). Replace them with a comma, semicolon or period, depending on the context.
+- Never exceed three lines per paragraph. Cut long ideas into several shorter blocks.
+
+Sujet : {subject}
+
 Contenu additionnel :
 {additional_content}
+"""
 
-Évalue cette section et mets-la à jour si besoin.
+SECTIONS_LIST_TEMPLATE = """Sections :
+{sections}
+
+Évalue chaque section et mets-la à jour si besoin.
 """
 
-    try:
-        llm = ChatAnthropic(
-            model="claude-sonnet-4-20250514",
-            temperature=0.4,
-            api_key=os.getenv("ANTHROPIC_API_KEY")
-        )
+SECTION_ENTRY_TEMPLATE = """[{section_id}] Titre : {title_text}
+Contenu HTML :
+{content_html}
+"""
 
-        logger.info(f"[GPT-BLOCK] Calling Claude for block: {title_text}")
-        response = llm.invoke(prompt)
-        result = response.content.strip()
 
-        if result.startswith("STATUS: VALID"):
+def build_sections_prompt(subject, group, additional_content):
+    """Build one evaluation prompt (content blocks) for a group of (block, title_text, content_html)"""
+    sections = "\n".join(
+        SECTION_ENTRY_TEMPLATE.format(section_id=i, title_text=title_text, content_html=content_html)
+        for i, (_, title_text, content_html) in enumerate(group, start=1)
+    )
+    return _cacheable_prompt(
+        SECTIONS_PROMPT_TEMPLATE.format(subject=subject, additional_content=additional_content),
+        SECTIONS_LIST_TEMPLATE.format(sections=sections)
+    )
+
+
+def parse_sections_response(result):
+    """Map section id -> (status, html) from a grouped answer; raises ValueError if it is not the expected JSON"""
+    match = _JSON_FENCE_RE.search(result)
+    payload = match.group(1) if match else result[result.find("["):result.rfind("]") + 1]
+    entries = orjson.loads(payload)
+    if not isinstance(entries, list):
+        raise ValueError("expected a JSON array")
+    return {int(entry["id"]): (entry["status"], entry.get("html") or "") for entry in entries}
+
+
+def parse_html_fragment(html_fragment):
+    """
+    Split an HTML fragment into serialized top-level pieces.
+    Blocks are only ever re-serialized afterwards, so lxml's C fragment parser is enough, no bs4 tree needed.
+    """
+    pieces = []
+    for fragment in lxml_html.fragments_fromstring(html_fragment):
+        if not isinstance(fragment, str):
+            fragment = lxml_html.tostring(fragment, encoding="unicode")
+        fragment = fragment.strip()
+        if fragment:
+            pieces.append(fragment)
+    return pieces
+
+
+def parse_block_response(block, result, title_text):
+    """Apply Claude's verdict to a block, keeping the original when it is still valid"""
+    match = _STATUS_RE.search(result)
+    status = match.group(1) if match else None
+
+    if status == "VALID":
+        return block
+
+    elif status in ("TO BE UPDATED", "OUTDATED"):
+        html_start = match.group(2).strip()
+        if not html_start:
+            logger.warning(f"[GPT-BLOCK] STATUS: {status} without HTML, keeping original: {title_text}")
             return block
+        updated_block = {
+            "title": block['title'],
+            "content": parse_html_fragment(html_start)
+        }
+        return updated_block
+
+    else:
+        logger.warning(f"[GPT-BLOCK] Unexpected response format: {title_text}")
+        return block
 
-        elif result.startswith("STATUS: TO BE UPDATED") or result.startswith("STATUS: OUTDATED"):
-            html_start = result.split("\n", 1)[1].strip()
-            soup = BeautifulSoup(html_start, "html.parser")
-            updated_block = {
-                "title": title,
-                "content": list(soup.contents)
-            }
-            return updated_block
 
-        else:
-            logger.warning(f"[GPT-BLOCK] Unexpected response format: {title_text}")
-            return block
+def _block_cache_key(subject, title_text, content_html, additional_content):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (CLAUDE_MODEL, subject, title_text, content_html, additional_content):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _cached_block_answer(key):
+    with _block_answers_lock:
+        answer = _block_answers.get(key)
+        if answer is not None:
+            _block_answers.move_to_end(key)
+        return answer
+
+
+def _store_block_answer(key, answer):
+    # Only well-formed verdicts are worth replaying
+    if BLOCK_CACHE_SIZE <= 0 or not _STATUS_RE.search(answer):
+        return
+    with _block_answers_lock:
+        _block_answers[key] = answer
+        _block_answers.move_to_end(key)
+        while len(_block_answers) > BLOCK_CACHE_SIZE:
+            _block_answers.popitem(last=False)
+
+
+@lru_cache(maxsize=8)
+def _get_llm(temperature, max_tokens):
+    """
+    Shared ChatAnthropic per (temperature, max_tokens), so its HTTP connections are reused across calls.
+    Built on first use rather than at import, once .env has been loaded.
+    Synchronous calls only: its async client would outlive the event loop of a pipeline run (see async_claude_client).
+    """
+    return ChatAnthropic(
+        model=CLAUDE_MODEL,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        api_key=os.getenv("ANTHROPIC_API_KEY")
+    )
+
+
+def async_claude_client():
+    """
+    AsyncAnthropic client for one asyncio.run of block updates, to be used as `async with` so it is closed
+    with that run: its pooled connections belong to the run's event loop and cannot be shared with another one
+    """
+    return anthropic.AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+
+
+def _message_text(message):
+    return "".join(part.text for part in message.content if part.type == "text").strip()
+
+
+async def _ask_claude_async(client, prompt, temperature, max_tokens):
+    message = await client.messages.create(
+        model=CLAUDE_MODEL,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return _message_text(message)
+
+
+async def update_block_if_needed_async(block, subject, additional_content, semaphore, client,
+                                       content_html=None, title_text=None, source_content=None):
+    """
+    Update a single block if needed, bounded by a shared semaphore; client comes from async_claude_client.
+    source_content is the text additional_content was derived from (e.g. summarized) and keys the answer cache.
+    """
+    if content_html is None:
+        content_html = block_content_html(block)
+    if title_text is None:
+        title_text = block_title_text(block)
+
+    cache_key = _block_cache_key(
+        subject, title_text, content_html, additional_content if source_content is None else source_content
+    )
+    try:
+        cached = _cached_block_answer(cache_key)
+        if cached is not None:
+            logger.info(f"[GPT-BLOCK] Reusing cached verdict for block: {title_text}")
+            return parse_block_response(block, cached, title_text)
+
+        prompt = build_block_prompt(subject, title_text, content_html, additional_content)
+
+        async with semaphore:
+            await wait_for_capacity_async(prompt)
+            logger.info(f"[GPT-BLOCK] Calling Claude for block: {title_text}")
+            result = await _ask_claude_async(client, prompt, 0.4, BLOCK_MAX_TOKENS)
+        updated_block = parse_block_response(block, result, title_text)
+        # Only answers that could be applied are replayed
+        _store_block_answer(cache_key, result)
+        return updated_block
 
     except Exception as e:
         logger.error(f"[GPT-BLOCK] ❌ Error processing block '{title_text}': {e}")
         return block
 
 
+async def update_block_group_async(group, subject, additional_content, semaphore, client, source_content=None):
+    """
+    Evaluate several blocks with a single prompt, group being a list of (block, title_text, content_html).
+    Returns the blocks in the same order; falls back to one call per block if the answer cannot be parsed.
+    """
+    prompt = build_sections_prompt(subject, group, additional_content)
+    titles = ", ".join(title_text for _, title_text, _ in group)
+
+    try:
+        async with semaphore:
+            await wait_for_capacity_async(prompt)
+            logger.info(f"[GPT-SECTIONS] Calling Claude for {len(group)} blocks: {titles}")
+            result = await _ask_claude_async(client, prompt, 0.4, SECTIONS_MAX_TOKENS)
+        verdicts = parse_sections_response(result)
+
+    except Exception as e:
+        logger.warning(f"[GPT-SECTIONS] Grouped evaluation failed ({e}), falling back to one call per block")
+        return await asyncio.gather(*(
+            update_block_if_needed_async(block, subject, additional_content, semaphore, client,
+                                         content_html=content_html, title_text=title_text,
+                                         source_content=source_content)
+            for block, title_text, content_html in group
+        ))
+
+    updated_blocks = []
+    for section_id, (block, title_text, _) in enumerate(group, start=1):
+        verdict = verdicts.get(section_id)
+        if verdict is None:
+            logger.warning(f"[GPT-SECTIONS] No verdict returned for block: {title_text}")
+            updated_blocks.append(block)
+            continue
+        status, html = verdict
+        try:
+            updated_blocks.append(parse_block_response(block, f"STATUS: {status}\n{html}", title_text))
+        except Exception as e:
+            logger.error(f"[GPT-SECTIONS] ❌ Error processing block '{title_text}': {e}")
+            updated_blocks.append(block)
+
+    return updated_blocks
+
+
+@lru_cache(maxsize=1)
+def _anthropic_client():
+    # Built on first use (after .env is loaded) and shared so its HTTP pool survives across articles
+    return anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+
+
+def update_blocks_via_batch(blocks, subject, additional_content):
+    """
+    Evaluate all blocks in a single Anthropic Message Batch.
+    Slower to come back than the online path, but half the token price and no per-block round-trip.
+    Raises if the batch cannot be submitted or does not end before BATCH_TIMEOUT.
+    """
+    # The API rejects an empty batch, e.g. when the relevance filter kept every block out
+    if not blocks:
+        return []
+
+    client = _anthropic_client()
+
+    batch_requests = []
+    titles = []
+    for i, block in enumerate(blocks):
+        content_html = block_content_html(block)
+        title_text = block_title_text(block)
+        titles.append(title_text)
+
+        batch_requests.append({
+            "custom_id": f"block-{i}",
+            "params": {
+                "model": CLAUDE_MODEL,
+                "max_tokens": BLOCK_MAX_TOKENS,
+                "temperature": 0.4,
+                "messages": [
+                    {"role": "user", "content": build_block_prompt(subject, title_text, content_html, additional_content)}
+                ]
+            }
+        })
+
+    batch = client.messages.batches.create(requests=batch_requests)
+    logger.info(f"[GPT-BATCH] Submitted batch {batch.id} with {len(batch_requests)} blocks")
+
+    deadline = time.monotonic() + BATCH_TIMEOUT
+    while batch.processing_status != "ended":
+        if time.monotonic() > deadline:
+            client.messages.batches.cancel(batch.id)
+            raise TimeoutError(f"Batch {batch.id} did not end within {BATCH_TIMEOUT}s")
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.messages.batches.retrieve(batch.id)
+
+    results = {}
+    for entry in client.messages.batches.results(batch.id):
+        if entry.result.type == "succeeded":
+            results[entry.custom_id] = _message_text(entry.result.message)
+        else:
+            logger.warning(f"[GPT-BATCH] {entry.custom_id} finished as {entry.result.type}")
+
+    updated_blocks = []
+    for i, block in enumerate(blocks):
+        result = results.get(f"block-{i}")
+        if result is None:
+            updated_blocks.append(block)
+            continue
+        try:
+            updated_blocks.append(parse_block_response(block, result, titles[i]))
+        except Exception as e:
+            logger.error(f"[GPT-BATCH] ❌ Error processing block '{titles[i]}': {e}")
+            updated_blocks.append(block)
+
+    logger.info(f"[GPT-BATCH] ✅ Batch {batch.id} done, {len(results)}/{len(blocks)} blocks answered")
+    return updated_blocks
+
+
+def summarize_additional_content(additional_content):
+    """
+    Condense a long additional content (usually a video transcript) once, so the block and
+    diagnostic prompts carry the summary instead of the full text. Returns the original on failure.
+    """
+    prompt = f"""
+### ROLE
+Tu es un journaliste jeu vidéo. Ton rôle est de résumer un contenu source pour qu'un autre rédacteur puisse mettre à jour un article.
+
+### GOAL
+Résume le contenu ci-dessous en 800 mots maximum, en français.
+
+### GUIDELINES
+- Conserve tous les faits vérifiables : noms, chiffres, dates, patchs, mécaniques de jeu, changements annoncés.
+- Conserve les avis et ressentis marquants exprimés dans le contenu.
+- Supprime les répétitions, digressions et formules d'introduction.
+- Réponds uniquement avec le résumé, sans commentaire.
+
+Contenu :
+{additional_content}
+"""
+
+    try:
+        llm = _get_llm(0.2, SUMMARY_MAX_TOKENS)
+
+        wait_for_capacity(prompt)
+        logger.info("[GPT-SUMMARY] Calling Claude...")
+        response = llm.invoke(prompt)
+        return response.content.strip() or additional_content
+
+    except Exception as e:
+        logger.error(f"[GPT-SUMMARY] ❌ Error: {e}")
+        return additional_content
+
+
 def diagnose_missing_sections(memory):
     prompt = f"""
 ### ROLE
@@ -110,16 +503,13 @@ Article HTML :
 {memory['original_html']}
 
 Contenu additionnel :
-{memory['additional_content']}
+{memory.get('additional_content_summary') or memory['additional_content']}
 """
 
     try:
-        llm = ChatAnthropic(
-            model="claude-sonnet-4-20250514",
-            temperature=0.5,
-            api_key=os.getenv("ANTHROPIC_API_KEY")
-        )
+        llm = _get_llm(0.5, DIAGNOSE_MAX_TOKENS)
 
+        wait_for_capacity(prompt)
         logger.info("[GPT-DIAGNOSTIC] Calling Claude...")
         response = llm.invoke(prompt)
         memory["diagnostic"] = response.content.strip()
@@ -166,12 +556,9 @@ Contenu additionnel :
 """
 
     try:
-        llm = ChatAnthropic(
-            model="claude-sonnet-4-20250514",
-            temperature=1.0,
-            api_key=os.getenv("ANTHROPIC_API_KEY")
-        )
+        llm = _get_llm(1.0, GENERATE_MAX_TOKENS)
 
+        wait_for_capacity(prompt)
         logger.info("[GPT-GENERATE] Calling Claude...")
         response = llm.invoke(prompt)
         memory["generated_sections"] = response.content.strip()
@@ -185,12 +572,13 @@ Contenu additionnel :
 
 
 def split_into_sections(html):
-    soup = BeautifulSoup(html, "html.parser")
+    # Accepts an already parsed tree to avoid parsing the article again
+    soup = html if isinstance(html, BeautifulSoup) else BeautifulSoup(html, HTML_PARSER)
     sections = []
     current_title = None
     current_content = []
 
-    for elem in soup.find_all(recursive=False):
+    for elem in (soup.body or soup).find_all(recursive=False):
         if elem.name == "h2":
             if current_title:
                 sections.append({"title": current_title, "content": current_content})
@@ -206,12 +594,12 @@ def split_into_sections(html):
 
 
 def parse_generated_sections(generated_html):
-    soup = BeautifulSoup(generated_html, "html.parser")
+    soup = BeautifulSoup(generated_html, HTML_PARSER)
     sections = []
     current_title = None
     current_content = []
 
-    for elem in soup.find_all(recursive=False):
+    for elem in (soup.body or soup).find_all(recursive=False):
         if elem.name == "h2":
             if current_title:
                 sections.append({"title": current_title, "content": current_content})
@@ -227,20 +615,22 @@ def parse_generated_sections(generated_html):
 
 
 def reconstruct_blocks(sections):
-    html = ""
+    parts = []
     for section in sections:
         if section['title']:
-            html += str(section['title']) + "\n"
-        for elem in section['content']:
-            html += str(elem) + "\n"
-    return html
+            parts.append(str(section['title']))
+        parts.extend(map(str, section['content']))
+    return "\n".join(parts) + "\n" if parts else ""
 
 
-def merge_final_article_structured(memory):
+def merge_final_article_structured(memory, reconstructed_soup=None):
+    """reconstructed_soup: memory["reconstructed_html"] already parsed, if the caller has it"""
     logger.info("[MERGE] Fusion structurée des sections générées...")
 
     try:
-        existing_sections = split_into_sections(memory["reconstructed_html"])
+        existing_sections = split_into_sections(
+            reconstructed_soup if reconstructed_soup is not None else memory["reconstructed_html"]
+        )
         generated_sections = parse_generated_sections(memory["generated_sections"])
 
         existing_titles = [s["title"].get_text(strip=True) for s in existing_sections]
@@ -263,6 +653,14 @@ def merge_final_article_structured(memory):
                 existing_sections.append(gen_sec)
 
         merged_html = reconstruct_blocks(existing_sections)
+
+        # Merging only adds to the existing sections: a heading or media of the article missing afterwards was dropped
+        lost = count_structure_tags(memory["reconstructed_html"]) - count_structure_tags(merged_html)
+        if sum(lost.values()) > MERGE_MAX_LOST_TAGS:
+            logger.warning(f"[MERGE] ⚠️ Fusion incomplète, éléments perdus : {dict(lost)} → concaténation")
+            memory["final_article"] = memory["reconstructed_html"] + "\n\n" + memory["generated_sections"]
+            return memory
+
         memory["final_article"] = merged_html
         logger.info(f"[MERGE] ✅ Fusion terminée : {len(merged_html)} caractères")
 
@@ -1,19 +1,29 @@
 import os
-import requests
-import json
-from bs4 import BeautifulSoup, Tag
-from urllib.parse import urlparse
+import asyncio
+from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+import atexit
 import logging
+import queue
+import tempfile
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
 
 from .utils import (
-    extract_html_blocks, reconstruct_blocks, load_html_file,
-    clean_all_images, simplify_youtube_embeds, restore_youtube_iframes_from_rll_div,
-    get_jwt_token, extract_slug_from_url, get_post_id_from_slug,
-    update_wordpress_article, strip_duplicate_title_and_featured_image
+    HTTP_SESSION, HTML_PARSER, declared_html_encoding, extract_html_blocks, reconstruct_blocks,
+    clean_and_fix_media_html,
+    fragment_html, html_text, word_set, term_overlap,
+    get_jwt_token, invalidate_jwt_token, extract_slug_from_url, get_post_id_from_slug, WORDPRESS_AUTH_REJECTED,
+    update_wordpress_article_html, strip_duplicate_title_and_featured_image_tree
 )
 from .gpt_operations import (
-    update_block_if_needed,
+    block_content_html,
+    block_title_text,
+    async_claude_client,
+    update_block_if_needed_async,
+    update_block_group_async,
+    update_blocks_via_batch,
+    summarize_additional_content,
     diagnose_missing_sections,
     generate_sections,
     merge_final_article_structured
@@ -21,10 +31,57 @@ from .gpt_operations import (
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging: records are formatted by the calling thread, then written to stderr by a listener thread,
+# so pipeline threads never wait on the stream
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
+# Upper bound on simultaneous Claude calls while updating blocks
+MAX_CONCURRENT_BLOCK_UPDATES = int(os.getenv("MAX_CONCURRENT_BLOCK_UPDATES", "5"))
+
+# Local outputs of each run, directories created once at import
+MEMORY_LOG_DIR = "logs/memory_pipeline"
+OUTPUT_PATH = "./generated/updated_pipeline_article.txt"
+os.makedirs(MEMORY_LOG_DIR, exist_ok=True)
+os.makedirs(os.path.dirname(OUTPUT_PATH), exist_ok=True)
+
+# Pipeline memory entries filled in by the later steps (each one also ends up as a Step 5 log file)
+_MEMORY_DEFAULTS = {
+    "additional_content_summary": "",
+    "diagnostic": "",
+    "generated_sections": "",
+    "reconstructed_html": "",
+    "final_article": ""
+}
+
+# WordPress lookups and local audit copies run off the critical path
+_BACKGROUND_IO = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pipeline-io")
+
+# Diagnose/generate branch, run alongside the block updates of each request
+_LLM_BRANCH = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PIPELINE_BRANCH_WORKERS", "8")),
+    thread_name_prefix="pipeline-llm"
+)
+
+# "online" (one concurrent request per block), "grouped" (several blocks per request)
+# or "batch" (Anthropic Message Batches API)
+BLOCK_UPDATE_MODE = os.getenv("BLOCK_UPDATE_MODE", "online")
+
+# Additional content longer than this (chars) is summarized once before the block and diagnostic
+# prompts; the full text still feeds the section generation (0 disables)
+SUMMARIZE_ADDITIONAL_CONTENT_OVER = int(os.getenv("SUMMARIZE_ADDITIONAL_CONTENT_OVER", "12000"))
+
+# Blocks sent together in "grouped" mode
+SECTIONS_PER_PROMPT = int(os.getenv("SECTIONS_PER_PROMPT", "6"))
+
+# Blocks sharing a smaller share of their words with the additional content are kept as-is
+# without asking Claude (0 disables the filter)
+BLOCK_RELEVANCE_THRESHOLD = float(os.getenv("BLOCK_RELEVANCE_THRESHOLD", "0"))
+
 
 def update_blog_article_pipeline(data):
     """
@@ -37,74 +94,94 @@ def update_blog_article_pipeline(data):
         article_url = data.get("article_url")
         subject = data.get("subject")
         additional_content = data.get("additional_content", "")
+        # Bulk runs are not latency-sensitive: evaluate the blocks through the cheaper Batches API
+        block_update_mode = "batch" if data.get("mode") == "bulk" else BLOCK_UPDATE_MODE
 
         logger.info(f"[STEP 0] Input validation:")
         logger.info(f"  - Article URL: {article_url}")
         logger.info(f"  - Subject: {subject}")
         logger.info(f"  - Additional content length: {len(additional_content)} chars")
+        logger.info(f"  - Block update mode: {block_update_mode}")
 
         if not article_url or not subject:
             logger.error("[STEP 0] Missing required data")
             return {'error': 'Données manquantes (article_url ou subject)'}
 
+        # Steps 7-8 only need the URL: authenticate and find the post while the article downloads
+        wordpress_lookup = _BACKGROUND_IO.submit(resolve_wordpress_post, article_url)
+
         # Step 1: Download article
         logger.info("[STEP 1] Downloading article...")
-        res = requests.get(article_url)
-        logger.info(f"[STEP 1] HTTP Status: {res.status_code}")
+        with HTTP_SESSION.get(article_url, stream=True, timeout=30) as res:
+            logger.info(f"[STEP 1] HTTP Status: {res.status_code}")
+
+            if res.status_code != 200:
+                logger.error(f"[STEP 1] Failed to download article: {res.status_code}")
+                return {'error': "Impossible de télécharger l'article"}
 
-        if res.status_code != 200:
-            logger.error(f"[STEP 1] Failed to download article: {res.status_code}")
-            return {'error': "Impossible de télécharger l'article"}
+            # requests falls back to ISO-8859-1 for text/* without a charset: trust the page's
+            # <meta charset> (or UTF-8) instead of running charset detection over the whole body
+            if "charset" not in res.headers.get("Content-Type", "").lower():
+                res.encoding = declared_html_encoding(res.content) or "utf-8"
+            existing_html = res.text
 
-        existing_html = res.text
         logger.info(f"[STEP 1] Downloaded HTML length: {len(existing_html)} chars")
+        logger.info("[STEP 1] ✅ Article downloaded")
 
-        with open("temp_article_pipeline.html", "w", encoding="utf-8") as f:
-            f.write(existing_html)
-        logger.info("[STEP 1] ✅ Article downloaded and saved")
+        # Steps 7-8 must succeed before any Claude call is spent on the article
+        wordpress_post = wordpress_lookup.result()
+        if wordpress_post.get("error"):
+            return {'error': wordpress_post["error"]}
+        jwt_token = wordpress_post["jwt_token"]
+        post_id = wordpress_post["post_id"]
 
         # Step 2: Initialize memory
         logger.info("[STEP 2] Initializing memory...")
         memory = {
             "subject": subject,
             "additional_content": additional_content,
-            "original_html": existing_html,
-            "diagnostic": "",
-            "generated_sections": "",
-            "reconstructed_html": "",
-            "final_article": ""
-        }
+            "original_html": existing_html
+        } | _MEMORY_DEFAULTS
         logger.info("[STEP 2] ✅ Memory initialized")
 
+        # Step 2.1: Summarize long additional content once for the per-block prompts
+        if SUMMARIZE_ADDITIONAL_CONTENT_OVER and len(additional_content) > SUMMARIZE_ADDITIONAL_CONTENT_OVER:
+            logger.info("[STEP 2.1] Summarizing additional content...")
+            memory["additional_content_summary"] = summarize_additional_content(additional_content)
+            logger.info(f"[STEP 2.1] ✅ Summary length: {len(memory['additional_content_summary'])} chars")
+        block_context = memory["additional_content_summary"] or additional_content
+
+        # Steps 3.2-3.3 only read the original article: start them while the blocks are updated
+        new_sections = _LLM_BRANCH.submit(diagnose_and_generate, memory)
+
         # Step 3.1: Update and reconstruct article
         logger.info("[STEP 3.1] Starting article reconstruction...")
         memory["reconstructed_html"] = update_and_reconstruct_article(
-            "temp_article_pipeline.html",
+            existing_html,
             subject,
-            additional_content
+            block_context,
+            mode=block_update_mode,
+            source_content=additional_content
         )
         logger.info(f"[STEP 3.1] ✅ Reconstructed HTML length: {len(memory['reconstructed_html'])} chars")
 
-        # Step 3.2: Diagnose missing sections
-        logger.info("[STEP 3.2] Diagnosing missing sections...")
-        diagnose_missing_sections(memory)
-        logger.info(f"[STEP 3.2] ✅ Diagnostic length: {len(memory['diagnostic'])} chars")
-        logger.info(f"[STEP 3.2] Diagnostic preview: {memory['diagnostic'][:200]}...")
-
-        # Step 3.3: Generate new sections
-        logger.info("[STEP 3.3] Generating new sections...")
-        generate_sections(memory)
-        logger.info(f"[STEP 3.3] ✅ Generated sections length: {len(memory['generated_sections'])} chars")
+        # Wait for steps 3.2-3.3
+        new_sections.result()
 
         # Step 3.4: Strip duplicate content
         logger.info("[STEP 3.4] Cleaning duplicate content...")
-        memory["reconstructed_html"] = strip_duplicate_title_and_featured_image(memory["reconstructed_html"])
+        # Parsed once here and reused by the merge
+        reconstructed_soup = BeautifulSoup(memory["reconstructed_html"], HTML_PARSER)
+        strip_duplicate_title_and_featured_image_tree(reconstructed_soup)
+        memory["reconstructed_html"] = fragment_html(reconstructed_soup)
         logger.info(f"[STEP 3.4] ✅ Cleaned HTML length: {len(memory['reconstructed_html'])} chars")
 
         # Step 3.5: Merge final article
         logger.info("[STEP 3.5] Merging final article...")
         from .gpt_operations import merge_final_article_structured
-        merge_final_article_structured(memory)
+        merge_final_article_structured(memory, reconstructed_soup=reconstructed_soup)
+        # Parsed trees weigh several times their HTML: release them as soon as they are consumed
+        del reconstructed_soup
         logger.info(f"[STEP 3.5] ✅ Final article length: {len(memory['final_article'])} chars")
 
         if not memory["final_article"]:
@@ -113,60 +190,49 @@ def update_blog_article_pipeline(data):
 
         # Step 4: HTML cleanup
         logger.info("[STEP 4] Cleaning HTML...")
-        soup_final = BeautifulSoup(memory["final_article"], "html.parser")
-        soup_final = clean_all_images(soup_final)
-        soup_final = simplify_youtube_embeds(soup_final)
-        soup_final = restore_youtube_iframes_from_rll_div(soup_final)
-        memory["final_article"] = str(soup_final)
+        memory["final_article"] = clean_and_fix_media_html(memory["final_article"])
         logger.info(f"[STEP 4] ✅ Final cleaned HTML length: {len(memory['final_article'])} chars")
 
-        # Step 5: Save logs
-        logger.info("[STEP 5] Saving logs...")
-        os.makedirs("logs/memory_pipeline", exist_ok=True)
-        for k, v in memory.items():
-            with open(f"logs/memory_pipeline/{k}.txt", "w", encoding="utf-8") as f:
-                f.write(str(v))
-        logger.info("[STEP 5] ✅ Logs saved")
-
-        # Step 6: Save article locally
-        logger.info("[STEP 6] Saving article locally...")
-        output_path = "./generated/updated_pipeline_article.txt"
-        os.makedirs("generated", exist_ok=True)
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(memory["final_article"])
-        logger.info(f"[STEP 6] ✅ Article saved to {output_path}")
-
-        # Step 7: WordPress authentication
-        logger.info("[STEP 7] Authenticating with WordPress...")
-        username = os.getenv("USERNAME_WP")
-        password = os.getenv("PASSWORD_WP")
-        logger.info(f"[STEP 7] Username: {username}")
-
-        jwt_token = get_jwt_token(username, password)
-        if not jwt_token:
-            logger.error("[STEP 7] JWT authentication failed")
-            return {'error': "Échec de l'authentification WordPress"}
-        logger.info("[STEP 7] ✅ JWT token obtained")
-
-        # Step 8: Get post ID
-        logger.info("[STEP 8] Getting post ID...")
-        slug = extract_slug_from_url(article_url)
-        logger.info(f"[STEP 8] Extracted slug: {slug}")
+        # Step 5: Save logs (one background write per file, all in flight while WordPress is being updated)
+        logger.info("[STEP 5] Saving logs in background...")
+        log_writes = [
+            _BACKGROUND_IO.submit(save_text_file, f"{MEMORY_LOG_DIR}/{k}.txt", str(v))
+            for k, v in memory.items()
+        ]
 
-        post_id = get_post_id_from_slug(slug, jwt_token)
-        if not post_id:
-            logger.error(f"[STEP 8] Post not found for slug: {slug}")
-            return {'error': f"Article introuvable pour le slug '{slug}'"}
-        logger.info(f"[STEP 8] ✅ Post ID found: {post_id}")
+        # Step 6: Save article locally (audit copy only, written while WordPress is being updated)
+        logger.info("[STEP 6] Saving article locally in background...")
+        local_copy = _BACKGROUND_IO.submit(save_text_file, OUTPUT_PATH, memory["final_article"], atomic=True)
 
-        # Step 9: Update WordPress
+        # Step 9: Update WordPress (token and post ID resolved in steps 7-8)
         logger.info("[STEP 9] Updating WordPress...")
-        success = update_wordpress_article(post_id, output_path, jwt_token)
-        if not success:
-            logger.error("[STEP 9] WordPress update failed")
+        status = update_wordpress_article_html(post_id, memory["final_article"], jwt_token)
+        if status in WORDPRESS_AUTH_REJECTED:
+            # The cached token may have been revoked: authenticate again and retry once
+            username, password = os.getenv("USERNAME_WP"), os.getenv("PASSWORD_WP")
+            invalidate_jwt_token(username, password)
+            jwt_token = get_jwt_token(username, password)
+            if jwt_token:
+                logger.warning("[STEP 9] ⚠️ JWT token rejected, retrying with a fresh one...")
+                status = update_wordpress_article_html(post_id, memory["final_article"], jwt_token)
+        if status is None or status >= 400:
+            logger.error(f"[STEP 9] WordPress update failed (HTTP {status})")
             return {'error': "Échec de la mise à jour sur WordPress"}
         logger.info(f"[STEP 9] ✅ WordPress updated successfully")
 
+        try:
+            for write in log_writes:
+                write.result()
+            logger.info("[STEP 5] ✅ Logs saved")
+        except Exception as e:
+            logger.error(f"[STEP 5] ❌ Saving logs failed: {e}")
+
+        try:
+            local_copy.result()
+            logger.info(f"[STEP 6] ✅ Article saved to {OUTPUT_PATH}")
+        except Exception as e:
+            logger.error(f"[STEP 6] ❌ Local copy failed: {e}")
+
         logger.info("=== PIPELINE COMPLETED SUCCESSFULLY ===")
         return {
             "message": f"✅ Article mis à jour avec succès sur WordPress (ID {post_id})",
@@ -183,30 +249,177 @@ def update_blog_article_pipeline(data):
         return {'error': f'Erreur interne : {str(e)}'}
 
 
-def update_and_reconstruct_article(filepath, subject, additional_content):
+def resolve_wordpress_post(article_url):
     """
-    Update and reconstruct article from HTML blocks
+    Steps 7-8: JWT token and post ID of the article, as {"jwt_token", "post_id"} or {"error"}
     """
-    logger.info("[RECONSTRUCT] Starting article reconstruction...")
+    # Step 7: WordPress authentication
+    logger.info("[STEP 7] Authenticating with WordPress...")
+    username = os.getenv("USERNAME_WP")
+    password = os.getenv("PASSWORD_WP")
+    logger.info(f"[STEP 7] Username: {username}")
+
+    jwt_token = get_jwt_token(username, password)
+    if not jwt_token:
+        logger.error("[STEP 7] JWT authentication failed")
+        return {'error': "Échec de l'authentification WordPress"}
+    logger.info("[STEP 7] ✅ JWT token obtained")
+
+    # Step 8: Get post ID
+    logger.info("[STEP 8] Getting post ID...")
+    slug = extract_slug_from_url(article_url)
+    logger.info(f"[STEP 8] Extracted slug: {slug}")
+
+    post_id, status = get_post_id_from_slug(slug, jwt_token)
+    if status in WORDPRESS_AUTH_REJECTED:
+        # The cached token may have been revoked: authenticate again and retry once
+        invalidate_jwt_token(username, password)
+        jwt_token = get_jwt_token(username, password)
+        if not jwt_token:
+            logger.error("[STEP 8] JWT authentication failed")
+            return {'error': "Échec de l'authentification WordPress"}
+        logger.warning("[STEP 8] ⚠️ JWT token rejected, retrying with a fresh one...")
+        post_id, status = get_post_id_from_slug(slug, jwt_token)
+    if not post_id:
+        logger.error(f"[STEP 8] Post not found for slug: {slug}")
+        return {'error': f"Article introuvable pour le slug '{slug}'"}
+    logger.info(f"[STEP 8] ✅ Post ID found: {post_id}")
 
-    html = load_html_file(filepath)
-    logger.info(f"[RECONSTRUCT] Loaded HTML length: {len(html)} chars")
+    return {"jwt_token": jwt_token, "post_id": post_id}
+
+
+def diagnose_and_generate(memory):
+    """
+    Steps 3.2-3.3: fill memory["diagnostic"] and memory["generated_sections"] from the original article
+    """
+    # Step 3.2: Diagnose missing sections
+    logger.info("[STEP 3.2] Diagnosing missing sections...")
+    diagnose_missing_sections(memory)
+    logger.info(f"[STEP 3.2] ✅ Diagnostic length: {len(memory['diagnostic'])} chars")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"[STEP 3.2] Diagnostic preview: {memory['diagnostic'][:200]}...")
+
+    # Step 3.3: Generate new sections
+    logger.info("[STEP 3.3] Generating new sections...")
+    generate_sections(memory)
+    logger.info(f"[STEP 3.3] ✅ Generated sections length: {len(memory['generated_sections'])} chars")
+
+
+def save_text_file(path, content, atomic=False):
+    """
+    Write content as UTF-8 bytes in one call; atomic writes go through a temporary file and os.replace
+    so a reader never sees a half-written file
+    """
+    data = content.encode("utf-8")
+    if not atomic:
+        with open(path, "wb") as f:
+            f.write(data)
+        return
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)  # mkstemp files are private to the owner
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def update_and_reconstruct_article(html, subject, additional_content, mode=BLOCK_UPDATE_MODE, source_content=None):
+    """
+    Update and reconstruct article from HTML blocks, mode being "online", "grouped" or "batch".
+    source_content: original additional content when additional_content is its summary, so cached
+    block answers are found again across runs whose summaries differ
+    """
+    logger.info("[RECONSTRUCT] Starting article reconstruction...")
+    logger.info(f"[RECONSTRUCT] Source HTML length: {len(html)} chars")
 
     blocks = extract_html_blocks(html)
     logger.info(f"[RECONSTRUCT] Extracted {len(blocks)} blocks")
 
-    updated_blocks = []
+    selected = select_blocks_to_evaluate(blocks, additional_content)
+    candidates = [blocks[i] for i in selected]
 
-    for i, block in enumerate(blocks):
-        title_text = "Sans titre"
-        if block['title']:
-            title_text = block['title'].get_text() if hasattr(block['title'], 'get_text') else 'Sans titre'
+    updated_candidates = None
+    if mode == "batch":
+        try:
+            updated_candidates = update_blocks_via_batch(candidates, subject, additional_content)
+        except Exception as e:
+            logger.error(f"[RECONSTRUCT] Batch update failed, falling back to online calls: {e}")
+
+    if updated_candidates is None and mode == "grouped":
+        updated_candidates = asyncio.run(update_blocks_in_groups(candidates, subject, additional_content, source_content))
+
+    if updated_candidates is None:
+        updated_candidates = asyncio.run(update_blocks_concurrently(candidates, subject, additional_content, source_content))
 
-        logger.info(f"[RECONSTRUCT] Processing block {i + 1}/{len(blocks)}: {title_text}")
-        updated_block = update_block_if_needed(block, subject, additional_content)
-        updated_blocks.append(updated_block)
+    updated_blocks = list(blocks)
+    for i, updated_block in zip(selected, updated_candidates):
+        updated_blocks[i] = updated_block
 
     reconstructed = reconstruct_blocks(updated_blocks)
     logger.info(f"[RECONSTRUCT] ✅ Reconstruction complete, length: {len(reconstructed)} chars")
 
-    return reconstructed
\ No newline at end of file
+    return reconstructed
+
+
+def select_blocks_to_evaluate(blocks, additional_content):
+    """
+    Indices of the blocks worth sending to Claude: those sharing enough words with the additional content
+    """
+    if BLOCK_RELEVANCE_THRESHOLD <= 0:
+        return list(range(len(blocks)))
+
+    reference_words = word_set(additional_content)
+    selected = []
+    for i, block in enumerate(blocks):
+        title_text = block_title_text(block)
+        block_text = title_text + " " + html_text(block_content_html(block))
+        overlap = term_overlap(block_text, reference_words)
+        if overlap >= BLOCK_RELEVANCE_THRESHOLD:
+            selected.append(i)
+        else:
+            logger.info(f"[RECONSTRUCT] Keeping block unchanged (overlap {overlap:.2f}): {title_text}")
+
+    logger.info(f"[RECONSTRUCT] {len(selected)}/{len(blocks)} blocks sent to Claude")
+    return selected
+
+
+async def update_blocks_concurrently(blocks, subject, additional_content, source_content=None):
+    """
+    Evaluate every block against Claude in parallel, preserving block order
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BLOCK_UPDATES)
+
+    # Each run gets its own client, bound to the loop asyncio.run created for it
+    async with async_claude_client() as client:
+        tasks = []
+        for i, block in enumerate(blocks):
+            title_text = block_title_text(block)
+            content_html = block_content_html(block)
+            logger.info(f"[RECONSTRUCT] Processing block {i + 1}/{len(blocks)}: {title_text} ({len(content_html)} chars)")
+            tasks.append(update_block_if_needed_async(
+                block, subject, additional_content, semaphore, client,
+                content_html=content_html, title_text=title_text, source_content=source_content
+            ))
+
+        return await asyncio.gather(*tasks)
+
+
+async def update_blocks_in_groups(blocks, subject, additional_content, source_content=None):
+    """
+    Evaluate blocks SECTIONS_PER_PROMPT at a time, one Claude call per group, groups in parallel
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BLOCK_UPDATES)
+    prepared = [(block, block_title_text(block), block_content_html(block)) for block in blocks]
+    groups = [prepared[i:i + SECTIONS_PER_PROMPT] for i in range(0, len(prepared), SECTIONS_PER_PROMPT)]
+    logger.info(f"[RECONSTRUCT] Evaluating {len(blocks)} blocks in {len(groups)} grouped calls")
+
+    async with async_claude_client() as client:
+        results = await asyncio.gather(*(
+            update_block_group_async(group, subject, additional_content, semaphore, client, source_content)
+            for group in groups
+        ))
+    return [block for group in results for block in group]
@@ -0,0 +1,72 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Anthropic account limits to pace the calls against, opt-in: set them to the account's tier (0 disables)
+REQUESTS_PER_MINUTE = int(os.getenv("ANTHROPIC_REQUESTS_PER_MINUTE", "0"))
+INPUT_TOKENS_PER_MINUTE = int(os.getenv("ANTHROPIC_INPUT_TOKENS_PER_MINUTE", "0"))
+
+
+class TokenBucket:
+    """Thread-safe token bucket holding `capacity` units, refilled at `rate` units per second"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        """Take `amount` units now and return the delay (seconds) before they may be spent"""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+# Shared by every thread and event loop of the process, since they all draw on the same API key
+_request_bucket = TokenBucket(REQUESTS_PER_MINUTE / 60, REQUESTS_PER_MINUTE) if REQUESTS_PER_MINUTE > 0 else None
+_token_bucket = TokenBucket(INPUT_TOKENS_PER_MINUTE / 60, INPUT_TOKENS_PER_MINUTE) if INPUT_TOKENS_PER_MINUTE > 0 else None
+
+
+def estimate_tokens(prompt):
+    """Rough input token count (~4 characters per token), good enough for pacing"""
+    if not isinstance(prompt, str):
+        # Content blocks, as built for prompt caching. The cached prefix is counted too: the first calls of an
+        # article run before any cache entry exists (cache writes count toward the limit), and prefixes below
+        # the minimum cacheable length are never cached
+        prompt = "".join(part.get("text", "") for part in prompt)
+    return len(prompt) // 4 + 1
+
+
+def _reserve(prompt):
+    delay = 0.0
+    if _request_bucket is not None:
+        delay = _request_bucket.reserve(1)
+    if _token_bucket is not None:
+        delay = max(delay, _token_bucket.reserve(estimate_tokens(prompt)))
+    if delay > 0:
+        logger.info(f"[RATE-LIMIT] Waiting {delay:.1f}s before calling Claude")
+    return delay
+
+
+def wait_for_capacity(prompt):
+    """Block until a request carrying `prompt` fits in the rate limits"""
+    delay = _reserve(prompt)
+    if delay > 0:
+        time.sleep(delay)
+
+
+async def wait_for_capacity_async(prompt):
+    """Async variant of wait_for_capacity"""
+    delay = _reserve(prompt)
+    if delay > 0:
+        await asyncio.sleep(delay)
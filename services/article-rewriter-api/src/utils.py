@@ -1,122 +1,268 @@
 import os
+import re
+import socket
+import atexit
+import time
+import base64
+import threading
+import orjson
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+from bs4 import NavigableString
+from lxml import etree, html as lxml_html
 import logging
+from collections import Counter
+from html import escape, unescape
 
-def load_html_file(filepath):
-    with open(filepath, "r", encoding="utf-8") as f:
-        return f.read()
+logger = logging.getLogger(__name__)
 
 
-def extract_html_blocks(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose sockets also enable TCP keepalive, on top of urllib3's default TCP_NODELAY"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _build_http_session():
+    # One pooled session per process so repeated calls to the same host reuse TCP/TLS connections
+    session = requests.Session()
+    session.headers.update({
+        "Connection": "keep-alive",
+        "User-Agent": f"article-rewriter-api/1.0 {requests.utils.default_user_agent()}"
+    })
+    # Retries cover connection errors and transient 5xx on idempotent calls (POST is not replayed on a response);
+    # once they are exhausted the last response is returned, for the caller to check its status as before
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+    # Pooled connections sit idle between pipeline runs: TCP keepalive stops NATs and proxies from dropping them
+    adapter = _KeepAliveAdapter(pool_connections=20, pool_maxsize=20, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+HTTP_SESSION = _build_http_session()
+atexit.register(HTTP_SESSION.close)
+
+# BeautifulSoup tree builder used for every article/fragment parse (C-backed, see fragment_html)
+HTML_PARSER = "lxml"
+
+
+_STRUCTURE_TAG_RE = re.compile(r"<(h[1-6]|figure|iframe|img)\b", re.IGNORECASE)
+
+
+def count_structure_tags(html):
+    """Count headings and media tags with one scan of the raw HTML"""
+    return Counter(m.group(1).lower() for m in _STRUCTURE_TAG_RE.finditer(html))
+
+
+_WORD_RE = re.compile(r"\w{4,}")
+
+# Frequent French/English words that say nothing about a section's topic
+_STOPWORDS = frozenset({
+    "avec", "dans", "pour", "mais", "plus", "sans", "sont", "être", "avoir", "fait", "faire", "tout", "tous",
+    "toutes", "cette", "ces", "comme", "aussi", "bien", "encore", "très", "peut", "votre", "vous", "nous",
+    "leur", "leurs", "elle", "elles", "entre", "alors", "donc", "quand", "depuis", "même", "autre", "autres",
+    "that", "this", "with", "from", "have", "your", "will", "they", "there", "their", "what", "when"
+})
+
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def html_text(fragment, separator=" "):
+    """Visible text of an HTML fragment, tags replaced by separator"""
+    return unescape(_TAG_RE.sub(separator, fragment))
+
+
+def word_set(text):
+    """Distinct lowercase words of 4+ letters, stopwords removed"""
+    return {w for w in (m.lower() for m in _WORD_RE.findall(text)) if w not in _STOPWORDS}
+
+
+def term_overlap(text, reference_words):
+    """Share of the distinct words of text that also appear in reference_words (0 when text has none)"""
+    words = word_set(text)
+    return len(words & reference_words) / len(words) if words else 0.0
+
+
+def fragment_html(soup):
+    """
+    Serialize a soup parsed with lxml without the <html>/<head>/<body> wrapper lxml adds around fragments
+    """
+    parts = []
+    for node in soup.contents:
+        if getattr(node, 'name', None) == 'html':
+            for section in node.contents:
+                if getattr(section, 'name', None) in ('head', 'body'):
+                    parts.append(section.decode_contents())
+                else:
+                    parts.append(_node_html(section))
+        else:
+            parts.append(_node_html(node))
+    return "".join(parts)
 
-    if not soup.body:
-        print("[DEBUG] Pas de <body> trouvé dans le HTML")
+
+def _node_html(node):
+    # str() of a string node is its raw text: output_ready keeps text escaped and comments delimited
+    return node.output_ready() if isinstance(node, NavigableString) else str(node)
+
+
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.IGNORECASE)
+
+
+def declared_html_encoding(content):
+    """Charset declared by a <meta> tag in the head of raw HTML bytes, or None"""
+    match = _META_CHARSET_RE.search(content[:4096])
+    return match.group(1).decode("ascii") if match else None
+
+
+# XHTML pages open with an XML declaration, whose encoding lxml refuses on already decoded text
+_XML_DECLARATION_RE = re.compile(r"^\ufeff?\s*<\?xml[^>]*\?>")
+
+
+def _parse_html_document(html):
+    """lxml document of decoded HTML, or None when there is no element in it (only whitespace or comments)"""
+    try:
+        return lxml_html.document_fromstring(_XML_DECLARATION_RE.sub("", html, count=1))
+    except etree.ParserError:
+        return None
+
+
+def _outer_html(elem):
+    return lxml_html.tostring(elem, encoding="unicode", with_tail=False)
+
+
+# extract_html_blocks: headings that start a block, tags kept when they carry one of _KEEP_CLASSES,
+# and plain content tags always kept
+_HEADING_TAGS = frozenset({'h1', 'h2', 'h3'})
+_CONTENT_TAGS = frozenset({
+    'p', 'ul', 'ol', 'img', 'figure', 'blockquote',
+    'div', 'section', 'a', 'strong', 'em', 'mark', 'iframe'
+})
+_KEEP_CLASSES = frozenset({
+    'wp-block-quote',
+    'cg-box-layout-eleven',
+    'wp-block-shortcode'
+})
+_PLAIN_CONTENT_TAGS = frozenset({'p', 'ul', 'ol', 'img', 'blockquote'})
+_WALKED_TAGS = tuple(_HEADING_TAGS | _CONTENT_TAGS)
+
+
+def extract_html_blocks(html_content):
+    """
+    Split the article into blocks {'title': heading HTML or None, 'content': [element HTML, ...]}.
+    Read-only walk on the lxml tree: no BeautifulSoup objects are built for extraction.
+    """
+    if not html_content or not html_content.strip():
+        return []
+    root = _parse_html_document(html_content)
+    if root is None:
+        return []
+
+    if root.find('body') is None:
+        logger.debug("Pas de <body> trouvé dans le HTML")
     else:
-        print("[DEBUG] <body> trouvé ✅")
+        logger.debug("<body> trouvé ✅")
 
     blocks = []
     current_block = []
     current_title = None
 
-    content_tags = [
-        'p', 'ul', 'ol', 'img', 'figure', 'blockquote',
-        'div', 'section', 'a', 'strong', 'em', 'mark', 'iframe'
-    ]
-    keep_classes = [
-        'wp-block-quote',
-        'cg-box-layout-eleven',
-        'wp-block-shortcode'
-    ]
-
-    content_root = soup.find('article') or soup
-    processed_elements = set()  # Track processed elements
-
-    for elem in content_root.descendants:
-        if not getattr(elem, 'name', None) or elem in processed_elements:
-            continue
+    content_root = root.find('.//article')
+    if content_root is None:
+        content_root = root
 
-        # Check if this element is already contained in a processed parent
-        if any(elem in parent.descendants for parent in processed_elements if hasattr(parent, 'descendants')):
-            continue
+    # Document-order walk driven by libxml2: only headings and content tags reach Python (comments and
+    # other tags are descended into without being yielded), and an element taken whole is not descended into
+    walker = etree.iterwalk(content_root, events=('start',), tag=_WALKED_TAGS)
+    for _, elem in walker:
+        tag = elem.tag
 
         # Titres : on découpe
-        if elem.name in ['h1', 'h2', 'h3']:
+        if tag in _HEADING_TAGS:
             if current_block:
                 blocks.append({'title': current_title, 'content': current_block})
                 current_block = []
-            current_title = elem
-            processed_elements.add(elem)
-
-        # For figures, add the entire figure and mark all its children as processed
-        elif elem.name == 'figure':
-            current_block.append(elem)
-            processed_elements.add(elem)
-            processed_elements.update(elem.find_all())
-
-        # Contenu riche
-        elif elem.name in content_tags:
-            # Skip if this element is already inside a processed figure
-            if elem.find_parent('figure') and elem.find_parent('figure') in processed_elements:
-                continue
-
-            # Garde les div/section spécifiques (affiliate, shortcode, citation, etc.)
-            cls = elem.get('class', [])
-            if isinstance(cls, str):
-                cls = [cls]
-            if any(c for c in cls if c in keep_classes):
-                current_block.append(elem)
-                processed_elements.add(elem)
-
-            # Contenu classique
-            elif elem.name in ['p', 'ul', 'ol', 'img', 'blockquote']:
-                # Only add img if not already in a figure
-                if elem.name == 'img' and elem.find_parent('figure'):
-                    continue
-                current_block.append(elem)
-                processed_elements.add(elem)
+            current_title = _outer_html(elem)
+            walker.skip_subtree()
+
+        # Figures are kept whole, with their images and captions
+        elif tag == 'figure':
+            current_block.append(_outer_html(elem))
+            walker.skip_subtree()
+
+        # Garde les div/section spécifiques (affiliate, shortcode, citation, etc.)
+        elif not _KEEP_CLASSES.isdisjoint(elem.get('class', '').split()):
+            current_block.append(_outer_html(elem))
+            walker.skip_subtree()
+
+        # Contenu classique
+        elif tag in _PLAIN_CONTENT_TAGS:
+            current_block.append(_outer_html(elem))
+            walker.skip_subtree()
 
     if current_block:
         blocks.append({'title': current_title, 'content': current_block})
 
-    print(f"[DEBUG] {len(blocks)} blocs extraits (avec blocs spéciaux)")
+    logger.debug(f"{len(blocks)} blocs extraits (avec blocs spéciaux)")
     return blocks
 
 
 def reconstruct_blocks(blocks):
-    html = ""
+    parts = []
     for block in blocks:
         if block['title']:
-            html += str(block['title']) + "\n"
-        for elem in block['content']:
-            html += str(elem) + "\n"
-    return html
-
-
-def strip_duplicate_title_and_featured_image(html):
-    soup = BeautifulSoup(html, 'html.parser')
+            parts.append(str(block['title']))
+        parts.extend(map(str, block['content']))
+    return "\n".join(parts) + "\n" if parts else ""
+
+
+def _first_title_and_featured_image(soup):
+    """
+    First <h1> and first img.wp-post-image outside of it, found in a single walk that stops as soon as both are known
+    """
+    h1 = main_img = None
+    for elem in soup.descendants:
+        name = elem.name
+        if name == 'h1':
+            if h1 is None:
+                h1 = elem
+        elif name == 'img' and main_img is None and 'wp-post-image' in elem.get('class', []):
+            # An image inside the removed H1 goes with it
+            if h1 is None or not any(parent is h1 for parent in elem.parents):
+                main_img = elem
+        if h1 is not None and main_img is not None:
+            break
+    return h1, main_img
+
+
+def strip_duplicate_title_and_featured_image_tree(soup):
+    """Remove the duplicate H1 and featured image from a parsed article, in place"""
+    h1, main_img = _first_title_and_featured_image(soup)
 
     # Supprimer H1
-    h1 = soup.find('h1')
     if h1:
-        print("[CLEAN] 🔠 H1 supprimé :", h1.text.strip()[:60])
+        logger.info(f"[CLEAN] 🔠 H1 supprimé : {h1.text.strip()[:60]}")
         h1.decompose()
 
     # Supprimer img principale (souvent wp-post-image)
-    main_img = soup.find('img', class_="wp-post-image")
     if main_img:
-        print("[CLEAN] 🖼️ Image principale supprimée")
+        logger.info("[CLEAN] 🖼️ Image principale supprimée")
         # Remove the entire figure if it only contains the main image
         figure_parent = main_img.find_parent('figure')
         if figure_parent and len(figure_parent.find_all(['img', 'video'])) == 1:
-            print("[CLEAN] 🖼️ Figure avec image principale supprimée")
+            logger.info("[CLEAN] 🖼️ Figure avec image principale supprimée")
             figure_parent.decompose()
         else:
             main_img.decompose()
     else:
-        print("[CLEAN] ℹ️ Aucune image wp-post-image trouvée à supprimer")
+        logger.info("[CLEAN] ℹ️ Aucune image wp-post-image trouvée à supprimer")
 
     # Also remove any figure that contains featured image classes or is the first large image
     featured_figures = soup.find_all('figure', class_=['wp-block-image', 'aligncenter', 'size-full'])
@@ -125,7 +271,7 @@ def strip_duplicate_title_and_featured_image(html):
         if img and (
                 'wp-post-image' in img.get('class', []) or 'featured' in img.get('class', []) or 'size-full' in img.get(
                 'class', [])):
-            print("[CLEAN] 🖼️ Figure avec image principale supprimée")
+            logger.info("[CLEAN] 🖼️ Figure avec image principale supprimée")
             figure.decompose()
             break  # Only remove the first featured image
 
@@ -135,106 +281,276 @@ def strip_duplicate_title_and_featured_image(html):
         if first_figure:
             img = first_figure.find('img')
             if img:
-                print("[CLEAN] 🖼️ Première figure (probablement image principale) supprimée")
+                logger.info("[CLEAN] 🖼️ Première figure (probablement image principale) supprimée")
                 first_figure.decompose()
 
-    return str(soup)
+    return soup
 
 
-def simplify_youtube_embeds(soup):
-    count = 0
-    for figure in soup.find_all("figure", class_="wp-block-embed-youtube"):
-        noscript = figure.find("noscript")
-        if noscript:
-            iframe = noscript.find("iframe")
-            if iframe:
-                figure.replace_with(iframe)
-                count += 1
-    print(f"[DEBUG] ✅ {count} blocs YouTube nettoyés (remplacés par <iframe>)")
-    return soup
+def tree_fragment_html(root):
+    """
+    lxml counterpart of fragment_html: content of <head>/<body> without the wrapper document_fromstring adds
+    """
+    parts = []
+    for section in root:
+        if section.text:
+            parts.append(escape(section.text, quote=False))
+        parts.extend(lxml_html.tostring(child, encoding="unicode") for child in section)
+    return "".join(parts)
 
 
-def restore_youtube_iframes_from_rll_div(soup):
-    count = 0
-    for div in soup.find_all("div", class_="rll-youtube-player"):
-        video_id = div.get("data-id")
-        if video_id:
-            iframe = soup.new_tag("iframe", width="800", height="450")
-            iframe['src'] = f"https://www.youtube.com/embed/{video_id}?feature=oembed"
-            iframe['title'] = div.get("data-alt", "Vidéo YouTube")
-            iframe['frameborder'] = "0"
-            iframe[
-                'allow'] = "accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture; web-share"
-            iframe['allowfullscreen'] = True
-            iframe['referrerpolicy'] = "strict-origin-when-cross-origin"
-            div.replace_with(iframe)
-            count += 1
-    print(f"[DEBUG] ✅ {count} iframes restaurés depuis <div.rll-youtube-player>")
-    return soup
+def _has_class(elem, name):
+    return name in (elem.get("class") or "").split()
+
+
+def _replace_element(old, new):
+    """Put new in place of old; the text following old stays where it was"""
+    new.tail = old.tail
+    old.getparent().replace(old, new)
+
+
+def _youtube_iframe_from_figure(figure):
+    noscript = figure.find(".//noscript")
+    if noscript is not None:
+        return noscript.find(".//iframe")
+    return None
+
+
+# Attributes of the iframe that replaces an rll-youtube-player div, in output order;
+# only src and title change from one video to the next
+_RLL_IFRAME_ATTRS = {
+    "width": "800",
+    "height": "450",
+    "src": None,
+    "title": None,
+    "frameborder": "0",
+    "allow": "accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture; web-share",
+    "allowfullscreen": "",
+    "referrerpolicy": "strict-origin-when-cross-origin",
+}
+
+
+def _iframe_from_rll_div(div):
+    video_id = div.get("data-id")
+    if not video_id:
+        return None
+    attrs = _RLL_IFRAME_ATTRS.copy()
+    attrs["src"] = f"https://www.youtube.com/embed/{video_id}?feature=oembed"
+    attrs["title"] = div.get("data-alt", "Vidéo YouTube")
+    # lxml escapes attribute values on serialization
+    return div.makeelement("iframe", attrs)
+
+
+def _is_svg_placeholder(img):
+    return img.get("src", "").startswith("data:image/svg+xml")
+
+
+def _restore_lazy_src(img):
+    if img.get("data-lazy-src"):
+        img.set("src", img.get("data-lazy-src"))
+        return True
+    elif img.get("data-lazy-srcset"):
+        srcset = img.get("data-lazy-srcset").split(",")[0]
+        img.set("src", srcset.strip().split(" ")[0])
+        return True
+    return False
+
+
+def _remove_placeholder_img(img):
+    """Remove an <img> and the <p> it leaves empty; returns True if the <p> was removed too"""
+    parent = img.getparent()
+    img.drop_tree()
+    # Supprimer <p> vide laissé derrière
+    if parent is not None and parent.tag == "p" and len(parent) == 0 and not (parent.text or "").strip():
+        parent.drop_tree()
+        return True
+    return False
+
+
+def _restore_picture_img(picture):
+    if picture.find(".//img") is not None:
+        return False
+
+    source = picture.find(".//source")
+    src = ""
 
+    # Récupération depuis data-lazy-srcset ou srcset
+    if source is not None and source.get("data-lazy-srcset"):
+        srcset = source.get("data-lazy-srcset")
+        src = srcset.split(",")[0].split(" ")[0].strip()
+    elif source is not None and source.get("srcset"):
+        srcset = source.get("srcset")
+        src = srcset.split(",")[0].split(" ")[0].strip()
 
-def clean_all_images(soup):
+    if not src:
+        return False
+
+    picture.append(picture.makeelement("img", {"src": src, "alt": picture.get("alt", "")}))
+    return True
+
+
+def clean_and_fix_media(root):
+    """
+    Restore lazy-loaded images, drop SVG placeholders and turn YouTube embeds back into plain iframes,
+    in a single walk over an lxml tree
+    """
     restored = 0
     removed_svg = 0
     removed_empty_p = 0
+    picture_restored = 0
+    youtube_simplified = 0
+    rll_restored = 0
 
-    # 1. Restaurer les vraies images à partir des balises lazy
-    for img in soup.find_all("img"):
-        if img.get("src", "").startswith("data:image/svg+xml"):
-            if img.get("data-lazy-src"):
-                img["src"] = img["data-lazy-src"]
-                restored += 1
-            elif img.get("data-lazy-srcset"):
-                srcset = img["data-lazy-srcset"].split(",")[0]
-                img["src"] = srcset.strip().split(" ")[0]
-                restored += 1
+    detached = set()  # elements inside a subtree that has already been replaced
+    pictures = []
 
-    # 2. Supprimer les <img> encore en SVG (placeholder)
-    for img in soup.find_all("img"):
-        if img.get("src", "").startswith("data:image/svg+xml"):
-            parent = img.parent
-            img.decompose()
-            removed_svg += 1
-            # Supprimer <p> vide laissé derrière
-            if parent and parent.name == "p" and not parent.text.strip() and len(parent.find_all()) == 0:
-                parent.decompose()
-                removed_empty_p += 1
-
-    # 3. Restaurer <img> manquant dans <picture> si nécessaire
-    picture_restored = 0
-    for picture in soup.find_all("picture"):
-        has_img = picture.find("img")
-        if not has_img:
-            source = picture.find("source")
-            src = ""
-
-            # Récupération depuis data-lazy-srcset ou srcset
-            if source and source.get("data-lazy-srcset"):
-                srcset = source["data-lazy-srcset"]
-                src = srcset.split(",")[0].split(" ")[0].strip()
-            elif source and source.get("srcset"):
-                srcset = source["srcset"]
-                src = srcset.split(",")[0].split(" ")[0].strip()
-
-            if src:
-                img_tag = soup.new_tag("img", src=src)
-                img_tag["alt"] = picture.get("alt", "")
-                picture.append(img_tag)
-                picture_restored += 1
-
-    if picture_restored:
-        print(f"[DEBUG] 🧩 {picture_restored} <img> restaurés dans <picture> manquants")
-
-    print(f"[DEBUG] ✅ {restored} images restaurées depuis lazy-src")
-    print(f"[DEBUG] 🗑️ {removed_svg} SVG placeholders supprimés")
-    print(f"[DEBUG] 🧼 {removed_empty_p} <p> vides supprimés")
-    print(f"[DEBUG] ℹ️ Conservation des images de contenu")
+    # Snapshot of the walk: the tree is modified while it is processed
+    for elem in list(root.iter("img", "picture", "figure", "div")):
+        if elem in detached:
+            continue
 
-    return soup
+        if elem.tag == "img":
+            if _is_svg_placeholder(elem) and _restore_lazy_src(elem):
+                restored += 1
+            if _is_svg_placeholder(elem):
+                removed_svg += 1
+                if _remove_placeholder_img(elem):
+                    removed_empty_p += 1
+
+        elif elem.tag == "picture":
+            # <img> placeholders inside come later in document order: fix pictures once they are cleaned
+            pictures.append(elem)
+
+        elif elem.tag == "figure" and _has_class(elem, "wp-block-embed-youtube"):
+            iframe = _youtube_iframe_from_figure(elem)
+            if iframe is not None:
+                detached.update(elem.iterdescendants())
+                _replace_element(elem, iframe)
+                youtube_simplified += 1
+
+        elif elem.tag == "div" and _has_class(elem, "rll-youtube-player"):
+            iframe = _iframe_from_rll_div(elem)
+            if iframe is not None:
+                detached.update(elem.iterdescendants())
+                _replace_element(elem, iframe)
+                rll_restored += 1
+
+    for picture in pictures:
+        if picture not in detached and _restore_picture_img(picture):
+            picture_restored += 1
+
+    # Summary only built when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        if picture_restored:
+            logger.debug(f"🧩 {picture_restored} <img> restaurés dans <picture> manquants")
+
+        logger.debug(f"✅ {restored} images restaurées depuis lazy-src")
+        logger.debug(f"🗑️ {removed_svg} SVG placeholders supprimés")
+        logger.debug(f"🧼 {removed_empty_p} <p> vides supprimés")
+        logger.debug(f"✅ {youtube_simplified} blocs YouTube nettoyés (remplacés par <iframe>)")
+        logger.debug(f"✅ {rll_restored} iframes restaurés depuis <div.rll-youtube-player>")
+
+    return root
+
+
+def clean_and_fix_media_html(html):
+    """Parse once with lxml, run clean_and_fix_media and serialize the fragment back"""
+    root = _parse_html_document(html)
+    if root is None:  # nothing but whitespace, comments or stray closing tags
+        return html
+    clean_and_fix_media(root)
+    return tree_fragment_html(root)
 
 
 # AUTHENTICATION JWT TOKEN
+# Tokens stay valid for hours: reuse them across pipeline runs until shortly before they expire
+JWT_FALLBACK_TTL = int(os.getenv("JWT_FALLBACK_TTL", "3600"))
+_JWT_EXPIRY_MARGIN = 60
+# Background refresh (see refresh_jwt_token): renew this long before expiry, retry this soon after a failure,
+# doubling the wait after each consecutive failure up to JWT_REFRESH_MAX_RETRY
+JWT_REFRESH_AHEAD = int(os.getenv("JWT_REFRESH_AHEAD", "300"))
+_JWT_REFRESH_RETRY = 60
+JWT_REFRESH_MAX_RETRY = int(os.getenv("JWT_REFRESH_MAX_RETRY", "3600"))
+# Consecutive 401/403 after which the background refresh stops: wrong or rotated credentials would otherwise
+# keep posting failed logins, which WordPress brute-force protection answers by locking the account or IP
+JWT_REFRESH_MAX_REJECTIONS = int(os.getenv("JWT_REFRESH_MAX_REJECTIONS", "3"))
+# Statuses meaning WordPress refused the credentials or token itself, as opposed to the request
+WORDPRESS_AUTH_REJECTED = (401, 403)
+_jwt_cache = {}
+_jwt_lock = threading.Lock()
+
+
+def _jwt_expiry(token):
+    """Expiry timestamp from the token's exp claim, or now + JWT_FALLBACK_TTL if it cannot be read"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(orjson.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + JWT_FALLBACK_TTL
+
+
+def _cached_jwt_token(username, password):
+    cached = _jwt_cache.get((username, password))
+    if cached and cached[1] - _JWT_EXPIRY_MARGIN > time.time():
+        return cached[0]
+    return None
+
+
 def get_jwt_token(username, password):
+    token = _cached_jwt_token(username, password)
+    if token:
+        logger.debug("♻️ Token JWT réutilisé depuis le cache.")
+        return token
+
+    # Pipelines run in worker threads: only one of them authenticates when the cache is cold
+    with _jwt_lock:
+        token = _cached_jwt_token(username, password)
+        if token:
+            return token
+        token = _fetch_jwt_token(username, password)
+        if token:
+            _jwt_cache[(username, password)] = (token, _jwt_expiry(token))
+    return token
+
+
+def refresh_jwt_token(username, password):
+    """
+    Fetch a new token once the cached one is within JWT_REFRESH_AHEAD of expiry, so requests always find a valid one.
+    Returns the number of seconds after which it should be called again; raises if the token cannot be fetched
+    (see jwt_refresh_backoff and jwt_credentials_rejected).
+    """
+    with _jwt_lock:
+        cached = _jwt_cache.get((username, password))
+        if not cached or cached[1] - JWT_REFRESH_AHEAD <= time.time():
+            token = _fetch_jwt_token(username, password, raise_errors=True)
+            if not token:
+                raise ValueError("no token in the WordPress response")
+            cached = _jwt_cache[(username, password)] = (token, _jwt_expiry(token))
+            logger.info("🔑 Token JWT rafraîchi en arrière-plan.")
+    return max(cached[1] - JWT_REFRESH_AHEAD - time.time(), _JWT_REFRESH_RETRY)
+
+
+def jwt_refresh_backoff(failures):
+    """Seconds to wait before the next refresh after `failures` consecutive failed ones"""
+    return min(_JWT_REFRESH_RETRY * 2 ** (failures - 1), JWT_REFRESH_MAX_RETRY)
+
+
+def jwt_credentials_rejected(error):
+    """True when a refresh failed because WordPress refused the credentials"""
+    response = getattr(error, "response", None)
+    return (
+        isinstance(error, requests.HTTPError) and response is not None
+        and response.status_code in WORDPRESS_AUTH_REJECTED
+    )
+
+
+def invalidate_jwt_token(username, password):
+    """Drop a cached token, e.g. after WordPress rejected a call made with it"""
+    _jwt_cache.pop((username, password), None)
+
+
+def _fetch_jwt_token(username, password, raise_errors=False):
     auth_url = "https://stuffgaming.fr/wp-json/jwt-auth/v1/token"
     payload = {
         "username": username,
@@ -242,56 +558,60 @@ def get_jwt_token(username, password):
     }
 
     try:
-        print(f"[DEBUG] Requête POST vers {auth_url} avec user={username}")
-        res = requests.post(auth_url, json=payload)
+        logger.debug(f"Requête POST vers {auth_url} avec user={username}")
+        res = HTTP_SESSION.post(
+            auth_url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, timeout=30
+        )
         res.raise_for_status()
-        token = res.json().get("token")
-        print("[DEBUG] ✅ Token JWT récupéré avec succès.")
+        token = orjson.loads(res.content).get("token")
+        logger.debug("✅ Token JWT récupéré avec succès.")
         return token
     except Exception as e:
-        print(f"[ERROR] ❌ Échec de récupération du token JWT : {e}")
+        logger.error(f"❌ Échec de récupération du token JWT : {e}")
         if 'res' in locals():
-            print(f"[DEBUG] ↪ Statut HTTP : {res.status_code}")
-            print(f"[DEBUG] ↪ Réponse brute : {res.text}")
+            logger.error(f"↪ Statut HTTP : {res.status_code}")
+            logger.error(f"↪ Réponse brute : {res.text}")
+        if raise_errors:
+            raise
         return None
 
 
 # WORDPRESS API
 def extract_slug_from_url(url):
-    path = urlparse(url).path
-    parts = [p for p in path.strip("/").split("/") if p]
-    return parts[-1] if parts else None
+    """Last non-empty path segment of the article URL, or None for a bare domain"""
+    path = url.split("#", 1)[0].split("?", 1)[0].rstrip("/")
+    head, _, slug = path.rpartition("/")
+    # "https://host" or "//host" has no path: the only segment left is the host itself
+    if not slug or head == "/" or head.endswith((":/", "//")):
+        return None
+    return slug
 
 
 def get_post_id_from_slug(slug, jwt_token):
+    """(post ID or None, HTTP status or None if WordPress could not be reached)"""
+    res = None
     try:
         api_url = f"https://stuffgaming.fr/wp-json/wp/v2/posts?slug={slug}"
         headers = {
             "Authorization": f"Bearer {jwt_token}"
         }
-        res = requests.get(api_url, headers=headers)
+        res = HTTP_SESSION.get(api_url, headers=headers, timeout=30)
         res.raise_for_status()
-        posts = res.json()
+        posts = orjson.loads(res.content)
         if posts:
-            return posts[0]['id']
+            return posts[0]['id'], res.status_code
         else:
-            print(f"[ERROR] Aucun article trouvé avec le slug : {slug}")
-            return None
+            logger.error(f"Aucun article trouvé avec le slug : {slug}")
+            return None, res.status_code
     except Exception as e:
-        print(f"[ERROR] Récupération ID article échouée : {e}")
-        return None
+        logger.error(f"Récupération ID article échouée : {e}")
+        return None, res.status_code if res is not None else None
 
 
-def update_wordpress_article(post_id, html_txt_file, jwt_token):
+def update_wordpress_article_html(post_id, html_content, jwt_token):
+    """HTTP status of the update (2xx on success), or None if WordPress could not be reached"""
     update_url = f"https://stuffgaming.fr/wp-json/wp/v2/posts/{post_id}"
 
-    try:
-        with open(html_txt_file, "r", encoding="utf-8") as f:
-            html_content = f.read()
-    except Exception as e:
-        print(f"[ERROR] ❌ Lecture du fichier HTML échouée : {e}")
-        return False
-
     headers = {
         "Authorization": f"Bearer {jwt_token}",
         "Content-Type": "application/json"
@@ -302,17 +622,19 @@ def update_wordpress_article(post_id, html_txt_file, jwt_token):
         "status": "private"
     }
 
-    print(f"[DEBUG] 🔄 Envoi de la mise à jour vers {update_url}")
-    print(f"[DEBUG] Payload size: {len(html_content)} caractères")
+    logger.debug(f"🔄 Envoi de la mise à jour vers {update_url}")
+    logger.debug(f"Payload size: {len(html_content)} caractères")
 
     try:
-        res = requests.post(update_url, headers=headers, json=payload)
+        # The article HTML dominates the body: encode it with orjson rather than the stdlib
+        res = HTTP_SESSION.post(update_url, headers=headers, data=orjson.dumps(payload), timeout=60)
         res.raise_for_status()
-        print(f"[✅] Article {post_id} mis à jour avec succès.")
-        return True
+        logger.info(f"✅ Article {post_id} mis à jour avec succès.")
+        return res.status_code
     except Exception as e:
-        print(f"[ERROR] ❌ Échec de la mise à jour de l'article : {e}")
+        logger.error(f"❌ Échec de la mise à jour de l'article : {e}")
         if 'res' in locals():
-            print(f"[DEBUG] ↪ Status: {res.status_code}")
-            print(f"[DEBUG] ↪ Response: {res.text}")
-        return False
\ No newline at end of file
+            logger.error(f"↪ Status: {res.status_code}")
+            logger.error(f"↪ Response: {res.text}")
+            return res.status_code
+        return None
\ No newline at end of file
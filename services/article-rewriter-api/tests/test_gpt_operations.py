@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from src import gpt_operations
+from src.gpt_operations import (
+    parse_sections_response,
+    parse_block_response,
+    update_block_if_needed_async,
+    update_block_group_async,
+)
+
+
+BLOCK = {'title': '<h2>Section</h2>', 'content': ['<p>Ancien texte</p>']}
+
+
+@pytest.fixture(autouse=True)
+def empty_block_cache():
+    gpt_operations._block_answers.clear()
+    yield
+    gpt_operations._block_answers.clear()
+
+
+@pytest.fixture
+def claude(monkeypatch):
+    """Replace the Claude call with queued answers; the prompts received are recorded in .prompts"""
+    class FakeClaude:
+        def __init__(self):
+            self.answers = []
+            self.prompts = []
+
+        async def __call__(self, client, prompt, temperature, max_tokens):
+            self.prompts.append(prompt)
+            return self.answers.pop(0)
+
+    fake = FakeClaude()
+    monkeypatch.setattr(gpt_operations, "_ask_claude_async", fake)
+    return fake
+
+
+def update_block(block, additional_content="contenu", source_content=None):
+    return asyncio.run(update_block_if_needed_async(
+        block, "Sujet", additional_content, asyncio.Semaphore(1), None, source_content=source_content
+    ))
+
+
+def update_group(blocks):
+    group = [(block, gpt_operations.block_title_text(block), gpt_operations.block_content_html(block))
+             for block in blocks]
+    return asyncio.run(update_block_group_async(group, "Sujet", "contenu", asyncio.Semaphore(2), None))
+
+
+class TestParseSectionsResponse:
+
+    def test_fenced_json(self):
+        result = 'Voici :\n```json\n[{"id": 1, "status": "VALID", "html": ""}, ' \
+                 '{"id": 2, "status": "OUTDATED", "html": "<p>Neuf</p>"}]\n```'
+        assert parse_sections_response(result) == {1: ("VALID", ""), 2: ("OUTDATED", "<p>Neuf</p>")}
+
+    def test_unfenced_json(self):
+        result = 'Réponse [{"id": "1", "status": "TO BE UPDATED", "html": null}] fin'
+        assert parse_sections_response(result) == {1: ("TO BE UPDATED", "")}
+
+    @pytest.mark.parametrize("result", ["pas de JSON", '```json\n{"id": 1}\n```', '[{"status": "VALID"}]'])
+    def test_garbage_raises(self, result):
+        with pytest.raises(Exception):
+            parse_sections_response(result)
+
+
+class TestParseBlockResponse:
+
+    def test_valid_keeps_block(self):
+        assert parse_block_response(BLOCK, "STATUS: VALID\nRien à changer.", "Section") is BLOCK
+
+    @pytest.mark.parametrize("status", ["TO BE UPDATED", "OUTDATED"])
+    def test_update_replaces_content(self, status):
+        updated = parse_block_response(BLOCK, f"STATUS: {status}\n<p>Un</p>\n<ul><li>Deux</li></ul>", "Section")
+        assert updated == {'title': BLOCK['title'], 'content': ['<p>Un</p>', '<ul><li>Deux</li></ul>']}
+
+    def test_status_after_preamble(self):
+        """The status line may follow a short preamble"""
+        updated = parse_block_response(BLOCK, "Analyse faite.\nSTATUS: OUTDATED\n<p>Neuf</p>", "Section")
+        assert updated['content'] == ['<p>Neuf</p>']
+
+    @pytest.mark.parametrize("result", ["STATUS: OUTDATED", "STATUS: TO BE UPDATED\n   ", "Je ne sais pas."])
+    def test_missing_html_or_status_keeps_block(self, result):
+        assert parse_block_response(BLOCK, result, "Section") is BLOCK
+
+
+class TestUpdateBlockIfNeededAsync:
+
+    def test_answer_cached_and_replayed(self, claude):
+        claude.answers = ["STATUS: OUTDATED\n<p>Neuf</p>"]
+
+        first = update_block(BLOCK)
+        second = update_block(BLOCK)
+
+        assert first == second == {'title': BLOCK['title'], 'content': ['<p>Neuf</p>']}
+        assert len(claude.prompts) == 1
+
+    def test_cache_keyed_on_source_content(self, claude):
+        """Runs whose summaries differ still share answers when they come from the same additional content"""
+        claude.answers = ["STATUS: VALID"]
+
+        update_block(BLOCK, additional_content="résumé 1", source_content="transcription")
+        update_block(BLOCK, additional_content="résumé 2", source_content="transcription")
+
+        assert len(claude.prompts) == 1
+
+    def test_unparsable_answer_not_cached(self, claude):
+        """An answer that cannot be applied keeps the block and is asked again next time"""
+        claude.answers = ["STATUS: OUTDATED\n<!DOCTYPE html>", "STATUS: OUTDATED\n<!DOCTYPE html>"]
+
+        assert update_block(BLOCK) is BLOCK
+        assert update_block(BLOCK) is BLOCK
+        assert len(claude.prompts) == 2
+
+    def test_bad_cached_answer_keeps_block(self, claude):
+        key = gpt_operations._block_cache_key("Sujet", "Section", "<p>Ancien texte</p>", "contenu")
+        gpt_operations._block_answers[key] = "STATUS: OUTDATED\n<!DOCTYPE html>"
+
+        assert update_block(BLOCK) is BLOCK
+        assert claude.prompts == []
+
+
+class TestUpdateBlockGroupAsync:
+
+    def test_grouped_verdicts(self, claude):
+        other = {'title': '<h2>Autre</h2>', 'content': ['<p>Texte</p>']}
+        claude.answers = ['```json\n[{"id": 1, "status": "VALID", "html": ""}, '
+                          '{"id": 2, "status": "OUTDATED", "html": "<p>Neuf</p>"}]\n```']
+
+        updated = update_group([BLOCK, other])
+
+        assert updated == [BLOCK, {'title': other['title'], 'content': ['<p>Neuf</p>']}]
+        assert len(claude.prompts) == 1
+
+    def test_falls_back_to_one_call_per_block(self, claude):
+        other = {'title': '<h2>Autre</h2>', 'content': ['<p>Texte</p>']}
+        claude.answers = ["pas de JSON", "STATUS: VALID", "STATUS: OUTDATED\n<p>Neuf</p>"]
+
+        updated = update_group([BLOCK, other])
+
+        assert updated == [BLOCK, {'title': other['title'], 'content': ['<p>Neuf</p>']}]
+        assert len(claude.prompts) == 3
+
+    def test_malformed_section_keeps_block(self, claude):
+        """One section whose HTML cannot be parsed does not fail the others"""
+        other = {'title': '<h2>Autre</h2>', 'content': ['<p>Texte</p>']}
+        claude.answers = ['[{"id": 1, "status": "OUTDATED", "html": "<html></html>"}, '
+                          '{"id": 2, "status": "OUTDATED", "html": "<p>Neuf</p>"}]']
+
+        updated = update_group([BLOCK, other])
+
+        assert updated == [BLOCK, {'title': other['title'], 'content': ['<p>Neuf</p>']}]
@@ -0,0 +1,220 @@
+import base64
+import time
+
+import orjson
+import pytest
+import requests
+from bs4 import BeautifulSoup
+
+from src import utils
+from src.utils import (
+    extract_html_blocks, clean_and_fix_media_html, fragment_html, extract_slug_from_url,
+    refresh_jwt_token, jwt_refresh_backoff, jwt_credentials_rejected
+)
+
+
+ARTICLE_HTML = """<html><head><title>Guide</title></head><body>
+<header><h1>Nom du site</h1></header>
+<article>
+<h1>Titre de l'article</h1>
+<p>Intro <strong>gras</strong></p>
+<!-- commentaire -->
+<h2>Section A</h2>
+<div class="wrapper"><p>Dans un div</p></div>
+<figure class="wp-block-image"><img src="a.jpg"><figcaption>Légende</figcaption></figure>
+<div class="wp-block-quote"><p>Citation</p></div>
+<p>Texte <img src="b.jpg"></p>
+<ul><li>un</li><li>deux</li></ul>
+<h3>Sous-section</h3>
+<blockquote><p>Bloc</p></blockquote>
+<span>ignoré</span>
+</article>
+<footer><p>Pied de page</p></footer>
+</body></html>"""
+
+MEDIA_HTML = """<p><img src="data:image/svg+xml,%3Csvg%3E" data-lazy-src="real.jpg" alt="a"></p>
+<p><img src="data:image/svg+xml,%3Csvg%3E"></p>
+<p>Texte <img src="data:image/svg+xml,x"></p>
+<img src="data:image/svg+xml,x" data-lazy-srcset="big.jpg 1024w, small.jpg 300w">
+<picture><source data-lazy-srcset="pic.webp 800w, pic2.webp 400w"><img src="data:image/svg+xml,x"></picture>
+<figure class="wp-block-embed wp-block-embed-youtube"><div class="wp-block-embed__wrapper"><div class="rll-youtube-player" data-id="abc"></div><noscript><iframe src="https://www.youtube.com/embed/abc"></iframe></noscript></div></figure> après
+<div class="rll-youtube-player" data-id="xyz" data-alt="Ma &quot;vidéo&quot;"></div>
+<img src="keep.jpg">"""
+
+
+class TestExtractHtmlBlocks:
+
+    def test_article_blocks(self):
+        """Blocks are cut on headings, only inside <article>, with kept elements serialized whole"""
+        blocks = extract_html_blocks(ARTICLE_HTML)
+
+        assert blocks == [
+            {
+                'title': "<h1>Titre de l'article</h1>",
+                'content': ['<p>Intro <strong>gras</strong></p>']
+            },
+            {
+                'title': '<h2>Section A</h2>',
+                'content': [
+                    '<p>Dans un div</p>',
+                    '<figure class="wp-block-image"><img src="a.jpg"><figcaption>Légende</figcaption></figure>',
+                    '<div class="wp-block-quote"><p>Citation</p></div>',
+                    '<p>Texte <img src="b.jpg"></p>',
+                    '<ul><li>un</li><li>deux</li></ul>'
+                ]
+            },
+            {
+                'title': '<h3>Sous-section</h3>',
+                'content': ['<blockquote><p>Bloc</p></blockquote>']
+            }
+        ]
+
+    def test_fragment_without_article(self):
+        """Without <article> the whole document is walked; content before the first heading has no title"""
+        blocks = extract_html_blocks("<p>Avant</p><h2>A</h2><p>x</p><section><p>y</p></section>")
+
+        assert blocks == [
+            {'title': None, 'content': ['<p>Avant</p>']},
+            {'title': '<h2>A</h2>', 'content': ['<p>x</p>', '<p>y</p>']}
+        ]
+
+    def test_heading_without_content(self):
+        """A trailing heading with nothing after it does not make a block"""
+        assert extract_html_blocks("<p>Avant</p><h2>B</h2>") == [{'title': None, 'content': ['<p>Avant</p>']}]
+
+    @pytest.mark.parametrize("html", ["", "   \n", "<!-- commentaire seul -->"])
+    def test_empty_input(self, html):
+        assert extract_html_blocks(html) == []
+
+    def test_xhtml_encoding_declaration(self):
+        """Decoded XHTML pages keep their XML declaration, which lxml refuses on str input"""
+        html = '<?xml version="1.0" encoding="UTF-8"?>\n<html><body><h2>A</h2><p>x</p></body></html>'
+        assert extract_html_blocks(html) == [{'title': '<h2>A</h2>', 'content': ['<p>x</p>']}]
+
+
+class TestCleanAndFixMediaHtml:
+
+    def test_media_cleanup(self):
+        """Lazy images restored, SVG placeholders and the paragraphs they leave empty removed, YouTube embeds simplified"""
+        cleaned = clean_and_fix_media_html(MEDIA_HTML)
+
+        assert cleaned.split("\n") == [
+            '<p><img src="real.jpg" data-lazy-src="real.jpg" alt="a"></p>',
+            '',
+            '<p>Texte </p>',
+            '<img src="big.jpg" data-lazy-srcset="big.jpg 1024w, small.jpg 300w">',
+            '<picture><source data-lazy-srcset="pic.webp 800w, pic2.webp 400w"></source>'
+            '<img src="pic.webp" alt=""></picture>',
+            '<iframe src="https://www.youtube.com/embed/abc"></iframe> après',
+            '<iframe width="800" height="450" src="https://www.youtube.com/embed/xyz?feature=oembed"'
+            ' title=\'Ma "vidéo"\' frameborder="0"'
+            ' allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture; web-share"'
+            ' allowfullscreen="" referrerpolicy="strict-origin-when-cross-origin"></iframe>',
+            '<img src="keep.jpg">'
+        ]
+
+    def test_html_without_media_is_unchanged(self):
+        html = "<h2>Titre</h2><p>Texte <strong>gras</strong></p>"
+        assert clean_and_fix_media_html(html) == html
+
+    @pytest.mark.parametrize("html", ["  ", "<!-- commentaire -->"])
+    def test_input_without_elements(self, html):
+        assert clean_and_fix_media_html(html) == html
+
+
+class TestFragmentHtml:
+
+    def test_wrapper_removed(self):
+        soup = BeautifulSoup("<h2>Titre</h2><p>Texte</p>", "lxml")
+        assert fragment_html(soup) == "<h2>Titre</h2><p>Texte</p>"
+
+    def test_top_level_text_stays_escaped(self):
+        """Escaped text must not turn into markup once the wrapper is dropped"""
+        soup = BeautifulSoup("Tom &amp; Jerry &lt;b&gt;<p>x</p>", "lxml")
+        assert fragment_html(soup) == "Tom &amp; Jerry &lt;b&gt;<p>x</p>"
+
+    def test_comments_keep_their_delimiters(self):
+        soup = BeautifulSoup("<!-- avant --><p>x</p><!-- après -->", "lxml")
+        assert fragment_html(soup) == "<!-- avant --><p>x</p><!-- après -->"
+
+
+class TestExtractSlugFromUrl:
+
+    @pytest.mark.parametrize("url, slug", [
+        ("https://stuffgaming.fr/mon-article/", "mon-article"),
+        ("https://stuffgaming.fr/guides/mon-article", "mon-article"),
+        ("https://stuffgaming.fr/mon-article/?utm_source=x#commentaires", "mon-article"),
+        ("https://stuffgaming.fr/mon-article#haut", "mon-article"),
+        ("https://stuffgaming.fr/", None),
+        ("https://stuffgaming.fr", None),
+        ("//stuffgaming.fr", None),
+    ])
+    def test_slug(self, url, slug):
+        assert extract_slug_from_url(url) == slug
+
+
+def make_jwt(exp):
+    payload = base64.urlsafe_b64encode(orjson.dumps({"exp": exp})).rstrip(b"=").decode()
+    return f"header.{payload}.signature"
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+class TestJwtToken:
+
+    @pytest.fixture(autouse=True)
+    def empty_jwt_cache(self):
+        utils._jwt_cache.clear()
+        yield
+        utils._jwt_cache.clear()
+
+    def test_expiry_from_exp_claim(self):
+        assert utils._jwt_expiry(make_jwt(1700000000)) == 1700000000
+
+    def test_expiry_fallback_for_unreadable_token(self):
+        before = time.time()
+        assert before + utils.JWT_FALLBACK_TTL <= utils._jwt_expiry("pas-un-jwt") <= time.time() + utils.JWT_FALLBACK_TTL
+
+    def test_refresh_fetches_and_schedules_before_expiry(self, monkeypatch):
+        token = make_jwt(time.time() + 7200)
+        monkeypatch.setattr(utils, "_fetch_jwt_token", lambda username, password, raise_errors=False: token)
+
+        delay = refresh_jwt_token("user", "secret")
+
+        assert utils.get_jwt_token("user", "secret") == token
+        assert 7200 - utils.JWT_REFRESH_AHEAD - 5 <= delay <= 7200 - utils.JWT_REFRESH_AHEAD
+
+    def test_refresh_keeps_a_fresh_token(self, monkeypatch):
+        token = make_jwt(time.time() + 7200)
+        utils._jwt_cache[("user", "secret")] = (token, utils._jwt_expiry(token))
+
+        def fetch(username, password, raise_errors=False):
+            raise AssertionError("no fetch expected")
+
+        monkeypatch.setattr(utils, "_fetch_jwt_token", fetch)
+        assert refresh_jwt_token("user", "secret") > 0
+
+    def test_refresh_raises_without_token(self, monkeypatch):
+        monkeypatch.setattr(utils, "_fetch_jwt_token", lambda username, password, raise_errors=False: None)
+        with pytest.raises(ValueError):
+            refresh_jwt_token("user", "secret")
+
+    def test_backoff_doubles_up_to_the_cap(self):
+        delays = [jwt_refresh_backoff(failures) for failures in range(1, 12)]
+        assert delays[:3] == [60, 120, 240]
+        assert delays == sorted(delays)
+        assert delays[-1] == utils.JWT_REFRESH_MAX_RETRY
+
+    @pytest.mark.parametrize("error, rejected", [
+        (http_error(401), True),
+        (http_error(403), True),
+        (http_error(500), False),
+        (requests.ConnectionError(), False),
+        (ValueError("no token"), False),
+    ])
+    def test_credentials_rejected(self, error, rejected):
+        assert jwt_credentials_rejected(error) is rejected
@@ -3,6 +3,7 @@ Metadata Generator Agent - Processes router data to generate article metadata
 """
 
 import os
+import asyncio
 import logging
 import uuid
 from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Depends
@@ -54,6 +55,11 @@ async def health_check():
     }
 
 
+def save_upload(file_path: str, content: bytes) -> None:
+    with open(file_path, "wb") as f:
+        f.write(content)
+
+
 @app.post("/generate-metadata", response_model=MetadataResponse)
 async def generate_metadata_endpoint(
         file: UploadFile = File(...),
@@ -66,26 +72,26 @@ async def generate_metadata_endpoint(
     session_id = f"metadata_{str(uuid.uuid4())[:8]}"
 
     try:
-        # Read file content
+        # Read file content (Starlette reads spooled-to-disk uploads in its threadpool)
         content = await file.read()
 
+        # Blocking steps below run in worker threads so the event loop keeps serving other requests
         # Save file to temp directory
         file_path = os.path.join("temp", f"{session_id}_{file.filename}")
-        with open(file_path, "wb") as f:
-            f.write(content)
+        await asyncio.to_thread(save_upload, file_path, content)
 
         # Parse CSV
-        input_data = parse_csv_input(content)
+        input_data = await asyncio.to_thread(parse_csv_input, content)
         keyword = input_data.keyword or 'unknown'
         logger.info(f"🔄 Processing metadata for keyword: {keyword}")
 
         # Generate metadata
-        metadata = generate_metadata(input_data, llm)
+        metadata = await asyncio.to_thread(generate_metadata, input_data, llm)
         logger.info(f"✅ Generated metadata for: {keyword}")
 
         # Forward to copywriter
         logger.info(f"📤 Forwarding to copywriter for: {keyword}")
-        copywriter_response = forward_to_copywriter(metadata, input_data, file_path)
+        copywriter_response = await asyncio.to_thread(forward_to_copywriter, metadata, input_data, file_path)
 
         # Prepare response based on copywriter success
         if copywriter_response.get("success"):
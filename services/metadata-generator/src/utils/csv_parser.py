@@ -12,9 +12,8 @@ def parse_csv_input(file_content: bytes) -> ParsedInputData:
     Parse CSV input file from router agent
     """
     try:
-        # Read CSV content
-        csv_text = file_content.decode('utf-8')
-        csv_reader = csv.DictReader(io.StringIO(csv_text))
+        # Read CSV content, decoding the bytes lazily: only the header and first row are ever decoded
+        csv_reader = csv.DictReader(io.TextIOWrapper(io.BytesIO(file_content), encoding='utf-8', newline=''))
         row = next(csv_reader)  # We only need the first row
 
         # DEBUG: Print all CSV headers and values
@@ -1,4 +1,4 @@
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 import os
 from dotenv import load_dotenv
@@ -37,12 +37,12 @@ class Settings(BaseSettings):
     # Port configuration
     port: int = 8086
 
-    class Config:
-        env_file = ".env"
-        extra = "allow"
-        # ADD THESE:
-        case_sensitive = False
-        env_file_encoding = 'utf-8'
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        extra="allow",
+        case_sensitive=False,
+        env_file_encoding='utf-8'
+    )
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)